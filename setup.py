@@ -73,7 +73,9 @@ setup(name="BarNone",
       version="0.1",
       packages=["BarNone"],
       package_dir={"BarNone": os.path.join("src", "BarNone")},
-      scripts=[os.path.join("scripts", "BarNone")],
+      scripts=[os.path.join("scripts", "BarNone"),
+               os.path.join("scripts", "BarNone-benchmark"),
+               os.path.join("scripts", "BarNone-serve")],
       ext_modules=[module1],
       cmdclass={"build": BarNoneBuild, "test": TestCommand},
       requires=["Levenshtein"],
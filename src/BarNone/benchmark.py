@@ -0,0 +1,306 @@
+"""
+Benchmark
+
+Generates synthetic sequencing runs from a barcode catalog, and measures how
+quickly BarNone matches and counts them
+"""
+
+import os
+import sys
+import json
+import random
+import bisect
+import resource
+import subprocess
+import collections
+from distutils.spawn import find_executable
+
+from BarNone import matching
+from BarNone import profiling
+from BarNone.profiling import timer
+
+
+NUCLEOTIDES = "ACGT"
+
+# sequence following the barcode in each synthetic read
+FLANK = "GTCGACCTGCAGCGTACG"
+
+TAG_LENGTH = 3
+MULTIPLEX_LENGTH = 6
+
+ITERATORS = {"fastq": matching.iterate_fastq, "qseq": matching.iterate_qseq,
+             "txt": matching.iterate_txt, "fasta": matching.iterate_fasta}
+
+
+### FUNCTIONS ###
+
+def random_sequence(l, rand=random):
+    return "".join([rand.choice(NUCLEOTIDES) for i in range(l)])
+
+
+def mutate(barcode, substitution=0, insertion=0, deletion=0, n_rate=0,
+           rand=random):
+    """
+    Introduce errors into a barcode: each base can be deleted, substituted or
+    followed by an insertion with the given probability, and is replaced by N
+    with probability n_rate
+    """
+    ret = []
+    for c in barcode:
+        r = rand.random()
+        if r < deletion:
+            continue
+        if r < deletion + substitution:
+            c = rand.choice([n for n in NUCLEOTIDES if n != c])
+        if rand.random() < n_rate:
+            c = "N"
+        ret.append(c)
+        if rand.random() < insertion:
+            ret.append(rand.choice(NUCLEOTIDES))
+    return "".join(ret)
+
+
+def format_read(seq, format, i):
+    """Return one read as an entry in the given file format"""
+    if format == "fastq":
+        return "@read%d\n%s\n+\n%s\n" % (i, seq, "I" * len(seq))
+    elif format == "fasta":
+        return ">read%d\n%s\n" % (i, seq)
+    elif format == "qseq":
+        return "\t".join(["BENCH", "1", "1", "1", str(i), "0", "0", "1", seq,
+                          "I" * len(seq), "1"]) + "\n"
+    elif format == "txt":
+        return seq + "\n"
+    raise ValueError("Unknown format %s" % format)
+
+
+def simulate(catalog_file, outdir, n, format="fastq", substitution=.01,
+             insertion=.001, deletion=.001, n_rate=.001, skew=1.0, samples=0,
+             mixed_lengths=0, uptag="TCT", downtag="TAG", seed=0):
+    """
+    Write a synthetic run of n reads drawn from a barcode catalog to outdir,
+    along with the catalog used (and a multiplex file if samples > 0).
+
+    Strain abundances follow a power law with exponent skew (0 is uniform).
+    A fraction mixed_lengths of barcodes are shortened by one or two bases.
+    Errors are introduced only into the barcode portion of each read.
+
+    Return a dictionary describing the files, the command line options needed
+    to read them, and the true number of reads generated for each
+    (sample, strain, tag).
+    """
+    rand = random.Random(seed)
+
+    inf = open(catalog_file)
+    catalog = [l[:-1].split("\t") for l in inf]
+    inf.close()
+
+    if mixed_lengths > 0:
+        catalog = [[s] + [b[:-rand.randint(1, 2)] if b != "" and
+                                rand.random() < mixed_lengths else b
+                            for b in (up, dn)]
+                        for s, up, dn in catalog]
+
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    ret = {"catalog": os.path.join(outdir, "catalog.txt"),
+           "reads": os.path.join(outdir, "reads." + format),
+           "multiplex": None,
+           "format": format}
+
+    with open(ret["catalog"], "w") as outf:
+        for row in catalog:
+            outf.write("\t".join(row) + "\n")
+
+    codes = []
+    if samples > 0:
+        ret["multiplex"] = os.path.join(outdir, "multiplex.txt")
+        while len(codes) < samples:
+            c = random_sequence(MULTIPLEX_LENGTH, rand)
+            if c not in codes:
+                codes.append(c)
+        with open(ret["multiplex"], "w") as outf:
+            for i, c in enumerate(codes):
+                outf.write("Sample%d\t%s\n" % (i, c))
+
+    # power law abundances, in a random order
+    order = list(range(len(catalog)))
+    rand.shuffle(order)
+    cumulative = []
+    total = 0
+    for rank in range(len(order)):
+        total += 1.0 / (rank + 1) ** skew
+        cumulative.append(total)
+
+    prefix_length = (MULTIPLEX_LENGTH if samples > 0 else 0)
+    barcode_length = max([len(b) for row in catalog for b in row[1:]])
+
+    truth = collections.defaultdict(int)
+    with open(ret["reads"], "w") as outf:
+        i = 0
+        while i < n:
+            rank = bisect.bisect(cumulative, rand.random() * total)
+            strain, up, dn = catalog[order[rank]]
+            whichtag = rand.randint(0, 1)
+            barcode = (up, dn)[whichtag]
+            if barcode == "":
+                continue
+
+            sample = rand.randrange(samples) if samples > 0 else None
+            seq = ((codes[sample] if samples > 0 else "") +
+                   (uptag, downtag)[whichtag] +
+                   mutate(barcode, substitution, insertion, deletion, n_rate,
+                          rand) + FLANK)
+            outf.write(format_read(seq, format, i))
+            truth[(sample, strain, whichtag)] += 1
+            i += 1
+
+    ret["truth"] = dict(truth)
+    ret["options"] = ["-f", format,
+                      "--uptag", uptag, "--downtag", downtag,
+                      "--tagstart", str(prefix_length + 1),
+                      "--taglength", str(TAG_LENGTH),
+                      "-s", str(prefix_length + TAG_LENGTH + 1),
+                      "-l", str(barcode_length)]
+    if samples > 0:
+        ret["options"] += ["--multiplexfile", ret["multiplex"],
+                           "--multiplexstart", "1",
+                           "--multiplexlength", str(MULTIPLEX_LENGTH)]
+    return ret
+
+
+def cache_statistics(counts):
+    """
+    Given the stage counts of a Profiler, return the number of barcode
+    searches answered by each level of the cache, and the fraction answered
+    without searching the index
+    """
+    hits = (counts.get("exact_hit", 0) + counts.get("cache_hit", 0) +
+            counts.get("cache_negative_hit", 0))
+    searches = counts.get("index_search", 0)
+    return {"exact_hits": counts.get("exact_hit", 0),
+            "cache_hits": counts.get("cache_hit", 0),
+            "negative_hits": counts.get("cache_negative_hit", 0),
+            "index_searches": searches,
+            "hit_rate": (float(hits) / (hits + searches)
+                            if hits + searches > 0 else None)}
+
+
+def count_simulated(sim, mismatches=3, profiler=None, index="simple",
+                    index_dir=None, cache_size=None, native=False):
+    """
+    Count a simulated run with a new BarcodeCounter, and return it along with
+    the seconds taken to build it and to count the reads. If native, count
+    within flamingo when the counter supports it (see
+    BarcodeCounter.count_native).
+    """
+    options = dict(zip(sim["options"][::2], sim["options"][1::2]))
+    tag_start = int(options["--tagstart"]) - 1
+    tag_end = tag_start + TAG_LENGTH
+    barcode_start = int(options["-s"]) - 1
+    barcode_end = barcode_start + int(options["-l"])
+
+    start = timer()
+    counter = matching.BarcodeCounter(sim["catalog"], options["--uptag"],
+                                      options["--downtag"], sim["multiplex"],
+                                      profiler=profiler, index=index,
+                                      index_dir=index_dir,
+                                      cache_size=cache_size)
+    build_time = timer() - start
+
+    start = timer()
+    if native and counter.native_supported():
+        counter.count_native(sim["reads"], sim["format"], barcode_start,
+                             barcode_end, tag_start, tag_end, mismatches)
+    else:
+        for l in ITERATORS[sim["format"]](sim["reads"]):
+            multiplex_code = (l[:MULTIPLEX_LENGTH] if sim["multiplex"]
+                                else None)
+            counter.add(l[barcode_start:barcode_end], l[tag_start:tag_end],
+                        mismatches, multiplex_code)
+    elapsed = timer() - start
+
+    return counter, build_time, elapsed
+
+
+def benchmark_counter(sim, mismatches=3, index="simple", index_dir=None,
+                      cache_size=None, profile=True, native=False):
+    """
+    Count a simulated run using a BarcodeCounter directly, with the given
+    index and cache options (see BarcodeCache), and within flamingo if
+    native and the options allow it. The run is timed without a
+    Profiler; if profile, it is counted again with one to measure how
+    often the caches are hit.
+    """
+    counter, build_time, elapsed = count_simulated(sim, mismatches,
+                                        index=index, index_dir=index_dir,
+                                        cache_size=cache_size, native=native)
+
+    ret = {"reads": counter.total,
+           "native": native and counter.native_supported(),
+           "found": counter.total_found,
+           "seconds": elapsed,
+           "reads_per_second": counter.total / elapsed if elapsed else None,
+           "index_build_seconds": build_time,
+           # kilobytes on Linux, bytes on OS X
+           "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+           "cache": None}
+
+    if profile:
+        profiler = profiling.Profiler()
+        count_simulated(sim, mismatches, profiler, index, index_dir,
+                        cache_size, native)
+        ret["cache"] = cache_statistics(profiler.counts)
+
+    return ret
+
+
+def benchmark_cli(sim, outdir, mismatches=3, script=None, options=[],
+                  profile=True):
+    """
+    Count a simulated run by calling the BarNone script in a separate
+    process, which should be the only child process run so far for its peak
+    RSS to be accurate. Any extra options are passed on to the script.
+
+    The run is timed without --statsfile; if profile, the script is run
+    again with it to measure index build time and cache hit rates, and
+    whether it counted within flamingo.
+    """
+    if script == None:
+        script = find_executable("BarNone")
+        if script == None:
+            raise Exception("Cannot find the BarNone script")
+
+    counts_file = os.path.join(outdir, "counts.txt")
+    command = ([sys.executable, script, sim["reads"], counts_file,
+                sim["catalog"], "-m", str(mismatches)] + sim["options"] +
+               options)
+
+    start = timer()
+    with open(os.devnull, "w") as devnull:
+        subprocess.check_call(command, stdout=devnull)
+    elapsed = timer() - start
+
+    reads = sum(sim["truth"].values())
+    ret = {"reads": reads,
+           "seconds": elapsed,
+           "reads_per_second": reads / elapsed if elapsed else None,
+           "index_build_seconds": None,
+           "peak_rss":
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+           "native": None,
+           "cache": None}
+
+    if profile:
+        stats_file = os.path.join(outdir, "stats.json")
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call(command + ["--statsfile", stats_file],
+                                  stdout=devnull)
+        with open(stats_file) as inf:
+            stats = json.load(inf)
+        ret["index_build_seconds"] = stats["times"].get("index_build")
+        ret["native"] = "count_native" in stats["counts"]
+        ret["cache"] = cache_statistics(stats["counts"])
+
+    return ret
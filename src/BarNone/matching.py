@@ -4,12 +4,18 @@ BarcodeCache
 Performs caching of barcodes, identifying mismatched ones using flamingo
 """
 
+import os
 import copy
+import math
+import random
+import cPickle
 import itertools
 import collections
 
 import flamingo
 
+from BarNone.profiling import timer
+
 
 ### FUNCTIONS ###
 
@@ -50,6 +56,139 @@ def iterate_txt(infile):
     inf.close()
 
 
+# flamingo indexes that a BarcodeCache can use: uncompressed, compressed by
+# discarding or by combining inverted lists, or stored on disk
+INDEXES = {"simple": flamingo.WrapperSimpleEd,
+           "discard": flamingo.WrapperDiscardListsEd,
+           "combine": flamingo.WrapperCombineListsEd,
+           "disk": flamingo.WrapperOnDiskEd}
+
+# a combined-list index chooses its lists from a 10% sample of the barcodes
+MIN_COMBINE_SIZE = 10
+
+# number of inexact searches between reorderings of the lengths probed
+REORDER_EVERY = 1000
+
+# number of lines in each record, and how to get the sequence from them
+RECORD_FORMATS = {"fastq": (4, lambda lines: lines[1]),
+                  "fasta": (2, lambda lines: lines[1]),
+                  "qseq": (1, lambda lines: lines[0].split("\t")[8]),
+                  "txt": (1, lambda lines: lines[0][:-1])}
+
+
+def iterate_offsets(infile, format, start=0):
+    """
+    Iterate over the sequences in a file of the given format, beginning at
+    byte offset start. Yield (offset, sequence) tuples, where offset is the
+    position just after that record, so it is possible to resume from there
+    """
+    lines_per_record, get_sequence = RECORD_FORMATS[format]
+
+    inf = open(infile)
+    inf.seek(start)
+    offset = start
+
+    while True:
+        lines = [inf.readline() for i in range(lines_per_record)]
+        if lines[-1] == "":
+            break
+        offset += sum(map(len, lines))
+        yield offset, get_sequence(lines)
+
+    inf.close()
+
+
+def find_record_start(inf, format, position):
+    """
+    Return the offset of the first record in an open file of the given format
+    that starts at or after position, or None if there isn't one
+    """
+    if position == 0:
+        return 0
+
+    # finish the line position is in
+    inf.seek(position - 1)
+    inf.readline()
+
+    while True:
+        start = inf.tell()
+        l = inf.readline()
+        if l == "":
+            return None
+        if format == "fastq":
+            # a quality line can start with @, but is never followed two lines
+            # later by a + line
+            inf.readline()
+            if l.startswith("@") and inf.readline().startswith("+"):
+                return start
+            inf.seek(start)
+            inf.readline()
+        elif format == "fasta":
+            if l.startswith(">"):
+                return start
+        else:
+            return start
+
+
+def iterate_blocks(infile, format, block_size=1000000, seed=None):
+    """
+    Iterate over the sequences in a file of the given format in blocks of
+    about block_size bytes, visiting the blocks in a random order so that any
+    prefix of the iteration is spread across the whole file. Yield (block,
+    sequence) tuples, where block is the number of blocks visited before this
+    one. Each record belongs to the block its first byte is in.
+    """
+    lines_per_record, get_sequence = RECORD_FORMATS[format]
+
+    starts = range(0, os.path.getsize(infile), block_size)
+    random.Random(seed).shuffle(starts)
+
+    inf = open(infile)
+    for block, block_start in enumerate(starts):
+        start = find_record_start(inf, format, block_start)
+        if start == None:
+            continue
+        inf.seek(start)
+        while inf.tell() < block_start + block_size:
+            lines = [inf.readline() for i in range(lines_per_record)]
+            if lines[-1] == "":
+                break
+            yield block, get_sequence(lines)
+
+    inf.close()
+
+
+def wilson_half_width(count, total, z=1.96):
+    """
+    Return the half-width of the Wilson score interval for a frequency of
+    count out of total, which unlike the normal approximation is not zero
+    for frequencies of zero or one
+    """
+    p = float(count) / total
+    return (z / (1 + z * z / total) *
+                math.sqrt(p * (1 - p) / total + z * z / (4.0 * total * total)))
+
+
+def cluster_half_width(count, total, squares, products, total_squares,
+                       blocks, z=1.96, total_blocks=None):
+    """
+    Return the half-width of the normal confidence interval for a frequency
+    of count out of total, when the reads were sampled in blocks rather than
+    independently. squares is the sum over blocks of the count within each
+    block squared, products the sum of the count within each block times the
+    block's total, and total_squares the sum of the block totals squared.
+    The variance is that of a ratio estimator, with each block a cluster,
+    corrected for the fraction of all total_blocks sampled if it is given.
+    """
+    p = float(count) / total
+    residuals = squares - 2 * p * products + p * p * total_squares
+    mean = float(total) / blocks
+    variance = residuals / (blocks * (blocks - 1) * mean * mean)
+    if total_blocks != None:
+        variance *= max(1 - float(blocks) / total_blocks, 0)
+    return z * math.sqrt(max(variance, 0))
+
+
 def closest_match(original, matches, unique=False):
     """
     Return the closest Levenshtein match if there is one. If unique, return
@@ -69,65 +208,194 @@ def closest_match(original, matches, unique=False):
 ### CLASSES ###
 
 class BarcodeCache(object):
-    def __init__(self, barcode_dict):
+    def __init__(self, barcode_dict, profiler=None, index="simple",
+                 index_dir=None, cache_size=None):
         """
         Given a dictionary mapping barcodes to values (none of which can
-        be None)
+        be None), and optionally a Profiler to record each search in.
+
+        index is one of the keys of INDEXES; a "disk" index is stored in
+        index_dir. If cache_size is given, each cache of inexact matches, and
+        the cache of misses, keeps at most that many of the barcodes most
+        recently added to it.
         """
+        if index not in INDEXES:
+            raise ValueError("Unknown index type %s" % index)
+        if index == "disk" and index_dir == None:
+            raise ValueError("A disk-based index needs an index_dir")
+
         self.barcode_dict = dict([(k, v)
                                     for k, v in barcode_dict.items()])
 
         # need to keep two caches- one for searches that are limited to unique
-        # items, and one for searches that aren't
-        self.cache_dicts = dict([(u, dict(self.barcode_dict.items()))
-                                    for u in (True, False)])
+        # items, and one for searches that aren't. Exact matches are found
+        # in barcode_dict, so these only hold inexact ones
+        self.cache_size = cache_size
+        self.cache_dicts = {True: self.new_cache(), False: self.new_cache()}
+        # barcodes with nothing in the index within the distance they were
+        # searched with, which doesn't depend on unique
+        self.misses = self.new_cache()
 
-        self.original = dict([(v, k) for k, v in barcode_dict.items()])
         self.strains = list(set(barcode_dict.values()))
-        self.index = flamingo.WrapperSimpleEd(self.barcode_dict.keys())
+
+        self.index_type = index
+        self.index_dir = index_dir
+        self.build_index()
+
+        self.profiler = profiler
+        # number of matches found in the cache and by looking them up
+        self.total_cached = 0
+        self.total_looked_up = 0
 
     def search(self, barcode, distance, verbose=False, details=False,
                 unique=False):
         """Search for the object mapping from a barcode"""
+        profiler = self.profiler
+
+        exact_match = self.barcode_dict.get(barcode)
+        if exact_match != None:
+            if profiler:
+                profiler.add("exact_hit")
+            self.total_cached += 1
+            return (exact_match, barcode) if details else exact_match
+
+        # the cache holds the closest barcode rather than its value, since
+        # several barcodes can map to the same value
         cache_match = self.cache_dicts[unique].get(barcode)
         if cache_match != None:
             # this is the closest match, so if it doesn't fit with this
             # distance, it won't work
-            original = self.original[cache_match]
-            if flamingo.distance(barcode, original) > distance:
+            if flamingo.distance(barcode, cache_match) > distance:
+                if profiler:
+                    profiler.add("cache_negative_hit")
                 return None
 
-            return (cache_match, original) if details else cache_match
+            if profiler:
+                profiler.add("cache_hit")
+            self.total_cached += 1
+            ret = self.barcode_dict[cache_match]
+            return (ret, cache_match) if details else ret
 
         if distance == 0:
             # won't be able to find any inexact matches anyway
             return None
 
+        missed = self.misses.get(barcode)
+        if missed != None and distance <= missed:
+            # nothing was found within a distance at least this large
+            if profiler:
+                profiler.add("cache_negative_hit")
+            return None
+
         # inexact match
+        start = timer() if profiler else None
         matches = self.index.search(barcode, distance)
+        if profiler:
+            profiler.add("index_search", start)
 
         if len(matches) == 0:
-            self.cache_dicts[unique][barcode] = None
+            self.add_to_cache(self.misses, barcode, distance)
             return None
 
+        start = timer() if profiler else None
         best = closest_match(barcode, matches, unique=unique)
+        if profiler:
+            profiler.add("closest_match", start)
 
         if best == None:
             return None
 
         ret = self.barcode_dict[best]
-        self.cache_dicts[unique][barcode] = ret
+        self.add_to_cache(self.cache_dicts[unique], barcode, best)
+        self.total_looked_up += 1
 
         return (ret, best) if details else ret
 
+    def new_cache(self):
+        """
+        Return an empty cache, which keeps the order barcodes were added in
+        if it is bounded
+        """
+        return dict() if self.cache_size == None else collections.OrderedDict()
+
+    def add_to_cache(self, cache, barcode, value):
+        """
+        Cache the result of an inexact search in one of cache_dicts or misses,
+        removing the oldest barcode if it would grow past cache_size
+        """
+        if self.cache_size != None and len(cache) >= self.cache_size:
+            cache.popitem(last=False)
+        cache[barcode] = value
+
+    def restore_cache(self, cache_dicts, misses):
+        """
+        Replace the caches with saved copies of cache_dicts and misses, which
+        may have been kept with a different cache_size, keeping the most
+        recently added barcodes if there are more than this one allows
+        """
+        self.cache_dicts = {True: self.new_cache(), False: self.new_cache()}
+        self.misses = self.new_cache()
+        for cache, saved in ([(self.cache_dicts[u], cache_dicts[u])
+                                for u in [True, False]] +
+                             [(self.misses, misses)]):
+            for barcode, value in saved.items():
+                self.add_to_cache(cache, barcode, value)
+
+    def build_index(self):
+        """Build the flamingo index of all barcodes"""
+        if self.index_type == "disk":
+            if not os.path.exists(self.index_dir):
+                os.makedirs(self.index_dir)
+            self.index = flamingo.WrapperOnDiskEd(self.barcode_dict.keys(),
+                                            os.path.abspath(self.index_dir))
+        elif (self.index_type == "combine" and
+                    len(self.barcode_dict) < MIN_COMBINE_SIZE):
+            # too few barcodes to choose lists to combine, or to need it
+            self.index = flamingo.WrapperSimpleEd(self.barcode_dict.keys())
+        else:
+            self.index = INDEXES[self.index_type](self.barcode_dict.keys())
+
+    def update(self, barcode_dict):
+        """
+        Given a new dictionary mapping barcodes to values, replace the
+        catalog with it, and update the index (in place if it is
+        uncompressed) for any barcodes that were removed or added
+        """
+        removed = [b for b in self.barcode_dict if b not in barcode_dict]
+        added = [b for b in barcode_dict if b not in self.barcode_dict]
+
+        self.barcode_dict = dict([(k, v) for k, v in barcode_dict.items()])
+        self.strains = list(set(barcode_dict.values()))
+        if len(removed) == 0 and len(added) == 0:
+            # the cache holds barcodes rather than values, so is still right
+            return
+
+        if isinstance(self.index, flamingo.WrapperSimpleEd):
+            for b in removed:
+                self.index.remove(b)
+            for b in added:
+                self.index.insert(b)
+        else:
+            # only the uncompressed index can be changed in place
+            self.build_index()
+
+        # cached inexact matches may no longer be the closest, and misses may
+        # now be close to a new barcode
+        self.cache_dicts = {True: self.new_cache(), False: self.new_cache()}
+        self.misses = self.new_cache()
+
 
 class BarcodeCacheMultipleLen(object):
     """Contains multiple BarcodeCaches, one for each possible length"""
-    def __init__(self, barcode_dict):
-        """Given a dictionary mapping barcodes to any kind of object"""
+    def __init__(self, barcode_dict, profiler=None, index="simple",
+                 index_dir=None, cache_size=None):
+        """
+        Given a dictionary mapping barcodes to any kind of object, and
+        optionally a Profiler shared by each BarcodeCache. The index options
+        and cache_size are passed on to each BarcodeCache, with a "disk" index
+        for each length stored in its own subdirectory of index_dir.
+        """
         # divide up the keys by length
-        self.original = dict([(v, k) for k, v in barcode_dict.items()])
-
         lengths = [l for l in map(len, barcode_dict) if l != 0]
         self.common_lengths = list(set(lengths))
         self.common_lengths.sort(key=lambda l: -lengths.count(l))
@@ -136,9 +404,22 @@ class BarcodeCacheMultipleLen(object):
 
         self.barcode_caches = dict([(l, BarcodeCache(dict([(k, v)
                                         for k, v in barcode_dict.items()
-                                            if len(k) == l])))
+                                            if len(k) == l]),
+                                    profiler=profiler, index=index,
+                                    index_dir=(os.path.join(index_dir, str(l))
+                                                if index_dir else None),
+                                    cache_size=cache_size))
                                         for l in self.common_lengths])
 
+        # lengths to probe for inexact matches, reordered as searches show
+        # which lengths the best matches come from
+        self.probe_order = list(self.common_lengths)
+        self.length_stats = dict([(l, {"probes": 0, "hits": 0, "wins": 0,
+                                       "skipped": 0, "seconds": 0.0})
+                                    for l in self.common_lengths])
+        self.inexact_searches = 0
+        self.profiler = profiler
+
     def get_strains(self):
         return list(set(itertools.chain(*[c.strains
                         for c in self.barcode_caches.values()])))
@@ -151,39 +432,88 @@ class BarcodeCacheMultipleLen(object):
         Search all sublengths of this barcode. Return either the matching
         name, or, if details=True, a 3-tuple:
         (name, matching barcode, length)
+
+        The best match is the closest to the whole barcode, so once one is
+        found, lengths too different from the barcode's to be as close are
+        skipped. For inexact searches, the lengths that most often give the
+        best match are tried first, and statistics on each are kept in
+        length_stats (timing each probe only if there is a profiler).
         """
         #print "search_all distance", distance
         matches = []
 
         # the order depends on the distance- if we need an exact match,
         # do it in descending order of length, if we are looking for an
-        # approximate one, do it in descending order of frequency
-        order = (self.common_lengths if distance != 0
-                    else self.descending_lengths)
+        # approximate one, do it in order of how often each length has had
+        # the best match
+        inexact = (distance != 0)
+        if inexact:
+            order = self.probe_order
+            self.inexact_searches += 1
+            if self.inexact_searches % REORDER_EVERY == 0:
+                self.reorder()
+        else:
+            order = self.descending_lengths
 
+        timed = inexact and self.profiler
+        best_distance = None
         for l in order:
+            stats = self.length_stats[l]
+            if best_distance != None and abs(len(barcode) - l) > best_distance:
+                # every barcode of this length is further from this one than
+                # the best match, so can't be closer or tie with it
+                stats["skipped"] += 1
+                continue
+
+            start = timer() if timed else None
             m = self.barcode_caches[l].search(barcode[:l],
                                                 distance, unique=unique,
                                                 details=True)
+            if inexact:
+                stats["probes"] += 1
+            if timed:
+                stats["seconds"] += timer() - start
+
             if m != None:
+                if inexact:
+                    stats["hits"] += 1
                 if m[1] == barcode[:l]:
                     # perfect match- unnecessary to check others
+                    if inexact:
+                        stats["wins"] += 1
                     return m + (l, ) if details else m[0]
-                matches.append(m + (l, ))
+                d = flamingo.distance(barcode, m[1])
+                matches.append((d, m[1], m[0], l))
+                if best_distance == None or d < best_distance:
+                    best_distance = d
 
         if len(matches) == 0:
             return None
-        elif len(matches) == 1:
-            return matches[0] if details else matches[0][0]
-        else:
-            # find the best one
-            closest = closest_match(barcode, [o for n, o, l in matches],
-                                    unique=unique)
-            if closest == None:
-                return None
-            best_match = [(n, o, l) for n, o, l in matches if o == closest]
 
-            return best_match[0] if details else best_match[0][0]
+        # find the best one, as closest_match would
+        d, original, name, l = min(matches)
+        if unique and [m[0] for m in matches].count(d) > 1:
+            return None
+        self.length_stats[l]["wins"] += 1
+
+        return (name, original, l) if details else name
+
+    def reorder(self):
+        """
+        Probe the lengths that have most often had the best match first,
+        otherwise keeping the current order
+        """
+        self.probe_order.sort(key=lambda l: -self.length_stats[l]["wins"])
+
+    def report(self, lengths=None):
+        """
+        return a one-line description of each length in the order they are
+        probed (or only the first lengths of them): how many inexact searches
+        it had the best match for, out of how many it was probed in
+        """
+        return " ".join(["%d:%d/%d" % (l, self.length_stats[l]["wins"],
+                                       self.length_stats[l]["probes"])
+                            for l in self.probe_order[:lengths]])
 
     def search(self, barcode, distance, unique=False, details=False,
                verbose=False):
@@ -199,6 +529,23 @@ class BarcodeCacheMultipleLen(object):
                                     details=details, verbose=verbose)
         return ret
 
+    def update(self, barcode_dict):
+        """
+        Given a new dictionary mapping barcodes to values, with no lengths
+        that weren't in the original, update each BarcodeCache with the
+        barcodes of its length
+        """
+        by_length = dict([(l, {}) for l in self.barcode_caches])
+        for k, v in barcode_dict.items():
+            if len(k) == 0:
+                continue
+            if len(k) not in by_length:
+                raise ValueError("Cannot add barcode %s of a new length" % k)
+            by_length[len(k)][k] = v
+
+        for l, d in by_length.items():
+            self.barcode_caches[l].update(d)
+
     def mismatch_table(self):
         return "".join([c.mismatch_table()
                             for c in self.barcode_caches.values()])
@@ -213,62 +560,141 @@ class SampleCounter(object):
         self.name = name
         self.cache = cache
         self.data = collections.defaultdict(int)
-
-    def add(self, barcode, dist, verbose=False):
+        self.reset_blocks()
+
+    def reset(self):
+        """Set all counts back to zero"""
+        self.data.clear()
+        self.reset_blocks()
+
+    def reset_blocks(self):
+        """Forget all blocks ended so far (see end_block)"""
+        # the counts as of the last block, and sums over the blocks of each
+        # strain's count squared and times the block's total
+        self.block_data = {}
+        self.block_squares = collections.defaultdict(int)
+        self.block_products = collections.defaultdict(int)
+        self.blocks = 0
+        self.block_total = 0
+        self.block_total_squares = 0
+
+    def add(self, barcode, dist, verbose=False, count=1):
         """
-        Add a barcode to the dictionary, and return the object and the barcode
-        it was matched to
+        Add a barcode to the dictionary (count times), and return the object
+        and the barcode it was matched to
         """
         matched = self.cache.search(barcode, dist, unique=True, details=True,
                                     verbose=verbose)
         if matched != None:
-            self.data[matched[0]] += 1
+            self.data[matched[0]] += count
 
         return matched
 
+    def end_block(self):
+        """
+        Record the barcodes counted since the last call as one block, which
+        precision treats as a cluster of reads
+        """
+        counts = dict([(s, c - self.block_data.get(s, 0))
+                            for s, c in self.data.items()])
+        block_total = sum(counts.values())
+        for s, c in counts.items():
+            self.block_squares[s] += c * c
+            self.block_products[s] += c * block_total
+
+        self.blocks += 1
+        self.block_total += block_total
+        self.block_total_squares += block_total * block_total
+        self.block_data = dict(self.data)
+
+    def precision(self, z=1.96, total_blocks=None):
+        """
+        Return the widest confidence interval half-width of any strain's
+        frequency among the barcodes counted, or None if there are none.
+
+        The Wilson interval assumes the reads are independent, but reads
+        sampled in blocks are clustered. So once two blocks have ended (see
+        end_block), a strain's interval is also at least as wide as the one
+        estimated from the variance between blocks, out of total_blocks in
+        the file if it is known.
+        """
+        total = sum(self.data.values())
+        if total == 0:
+            return None
+
+        counts = self.data.values()
+        if len(self.data) < len(self.cache.strains):
+            # some strains haven't been seen
+            counts.append(0)
+        widths = [wilson_half_width(c, total, z) for c in counts]
+
+        if self.blocks >= 2 and self.block_total > 0:
+            widths += [cluster_half_width(c, self.block_total,
+                                          self.block_squares[s],
+                                          self.block_products[s],
+                                          self.block_total_squares,
+                                          self.blocks, z, total_blocks)
+                            for s, c in self.block_data.items()]
+        return max(widths)
+
 
 class BarcodeCounter(object):
     """Can count barcodes based on a barcode file"""
     def __init__(self, infile, upcode, downcode, multiplex_file=None,
-                 track_mismatches=False):
+                 track_mismatches=False, track_reads=False, profiler=None,
+                 index="simple", index_dir=None, cache_size=None):
         """
         Given a tab-delimited barcode file, of the format
         Strain  Uptag   Downtag
         Keep track of tags and multiplex barcodes using a BarcodeCache, and
         the barcodes themselves using a BarcodeCacheMultipleLen.
+
+        If track_reads is True, keep a table of how many times each distinct
+        read was added, so that it can be recounted against a revised catalog
+        without reading the file again.
+
+        If given a Profiler, record the time spent decoding tags and multiplex
+        codes and searching for barcodes in it.
+
+        index, index_dir and cache_size determine the index and cache used by
+        each BarcodeCacheMultipleLen (see BarcodeCache).
         """
         self.tagcache = BarcodeCache({upcode: 0, downcode: 1})
+        self.profiler = profiler
+        self.cache_size = cache_size
 
         self.total = 0
         self.total_found = 0
+        # total when the last block of reads ended (see end_block)
+        self.block_start = 0
 
         inf = open(infile)
-        uptags = {}
-        downtags = {}
         self.original = [l[:-1].split("\t") for l in inf]
-        for strain, uptag, downtag in self.original:
-            uptags[uptag] = downtags[downtag] = strain
-
         inf.close()
 
-        self.upcache = BarcodeCacheMultipleLen(uptags)
-        self.downcache = BarcodeCacheMultipleLen(downtags)
+        self.upcache, self.downcache = [BarcodeCacheMultipleLen(tags,
+                            profiler=profiler, index=index,
+                            index_dir=(os.path.join(index_dir, name)
+                                        if index_dir else None),
+                            cache_size=cache_size)
+                        for tags, name in zip(self.catalog_dicts(),
+                                              ["up", "down"])]
 
         if multiplex_file != None:
             # create SampleCounters as a dictionary of 2-tuples
             inf = open(multiplex_file)
             counters = {}
+            self.ordered_counters = []
             for l in inf:
                 strain, barcode = l[:-1].split("\t")
                 counters[barcode] = (SampleCounter(self.upcache,
                                                     strain + "_UP"),
                                      SampleCounter(self.downcache,
                                                     strain + "_DOWN"))
+                self.ordered_counters.extend(counters[barcode])
             self.counters = BarcodeCache(counters)
             inf.close()
             self.multiplexed = True
-            self.ordered_counters = list(itertools.chain(*
-                                            self.counters.strains))
         else:
             # single pair of SampleCounter
             self.counter = (SampleCounter(self.upcache),
@@ -277,47 +703,130 @@ class BarcodeCounter(object):
             self.ordered_counters = self.counter[:]
 
         if track_mismatches:
-            # mismatches are indexed by tag, then by name, then by mismatched
-            # barcode
+            # mismatches are indexed by tag, then by (name, original barcode),
+            # since a name can appear with several barcodes, then by
+            # mismatched barcode
             self.mismatches = [collections.defaultdict(lambda:
                                         collections.defaultdict(int))
                                     for i in range(2)]
         else:
             self.mismatches = None
 
-    def add(self, barcode, tagcode, dist, multiplex_code=None, verbose=False):
-        """Add a barcode to the appropriate tag"""
+        if track_reads:
+            # indexed by (barcode, tagcode, multiplex_code)
+            self.reads = collections.defaultdict(int)
+        else:
+            self.reads = None
+
+    def catalog_dicts(self):
+        """
+        Return two dictionaries (up and down) mapping each barcode in the
+        catalog to its strain. A barcode that appears for several strains
+        belongs to the last of them
+        """
+        uptags = {}
+        downtags = {}
+        for strain, uptag, downtag in self.original:
+            uptags[uptag] = downtags[downtag] = strain
+        return uptags, downtags
+
+    def add(self, barcode, tagcode, dist, multiplex_code=None, verbose=False,
+            count=1):
+        """Add a barcode (count times) to the appropriate tag"""
         if self.multiplexed == False and multiplex_code != None:
             raise ValueError("Cannot use multiplex_code, BarcodeCounter " +
                              "was not given a multiplexing file")
         elif self.multiplexed == True and multiplex_code == None:
             raise ValueError("Need multiplexed code")
 
-        self.total += 1
+        if self.reads != None:
+            self.reads[(barcode, tagcode, multiplex_code)] += count
+
+        self.total += count
 
+        profiler = self.profiler
+
+        start = timer() if profiler else None
         whichtag = self.tagcache.search(tagcode, 1)
+        if profiler:
+            profiler.add("tag_decode", start)
         if whichtag == None:
             return False
 
         if self.multiplexed:
+            start = timer() if profiler else None
             counter = self.counters.search(multiplex_code, 1)
+            if profiler:
+                profiler.add("multiplex_decode", start)
             if counter == None:
                 return False
         else:
             counter = self.counter
 
-        found = counter[whichtag].add(barcode, dist, verbose=verbose)
+        found = counter[whichtag].add(barcode, dist, verbose=verbose,
+                                      count=count)
         if found != None:
-            self.total_found += 1
+            self.total_found += count
 
             name, original, length = found
 
             # add to mismatch dictionary
             if self.mismatches:
-                self.mismatches[whichtag][name][barcode[:length]] += 1
+                key = (name, original)
+                self.mismatches[whichtag][key][barcode[:length]] += count
 
         return found
 
+    def native_supported(self):
+        """
+        Return whether count_native can be used: it doesn't handle
+        multiplexing, tracking mismatches or reads, or a bounded cache
+        """
+        return (not self.multiplexed and self.mismatches == None and
+                self.reads == None and self.cache_size == None)
+
+    def count_native(self, infile, format, barcode_start, barcode_end,
+                     tag_start, tag_end, dist, n=None):
+        """
+        Count the reads in a file (or the first n) within flamingo, giving the
+        same counts as calling add on each. Reads are parsed, sliced and
+        matched exactly in C++, and each distinct tag code and inexact barcode
+        is only searched for in Python the first time it is seen.
+
+        A Profiler records the reads as parsed, the time spent in flamingo
+        as count_native, and the searches made in Python.
+        """
+        if not self.native_supported():
+            raise ValueError("This BarcodeCounter must count in Python")
+
+        # the exact matches of each length, longest first, are looked up in
+        # place rather than copied
+        exact = [[counter.cache.barcode_caches[l].barcode_dict
+                    for l in counter.cache.descending_lengths]
+                    for counter in self.counter]
+
+        def decode_tag(tagcode):
+            return self.tagcache.search(tagcode, 1)
+
+        def resolve(whichtag, barcode):
+            return self.counter[whichtag].cache.search(barcode, dist,
+                                                       unique=True)
+
+        start = timer() if self.profiler else None
+        total, found, counts = flamingo.count_reads(infile, format,
+                                    barcode_start, barcode_end, tag_start,
+                                    tag_end, exact, decode_tag, resolve,
+                                    n if n != None else -1)
+        if self.profiler:
+            self.profiler.add("count_native", start)
+            self.profiler.add("parse", count=total)
+
+        self.total += total
+        self.total_found += found
+        for counter, c in zip(self.counter, counts):
+            for name, count in c.items():
+                counter.data[name] += count
+
     def mismatch_table(self, outfile=None):
         """return a string describing all mismatches that have occured"""
         if self.mismatches == None:
@@ -326,15 +835,15 @@ class BarcodeCounter(object):
 
         ret = ""
 
-        originals = [c.original for c in [self.upcache, self.downcache]]
-
-        for mm_dict, original in zip(self.mismatches, originals):
-            for n, bc_dict in mm_dict.items():
-                o = original[n]
+        for mm_dict in self.mismatches:
+            for (n, o), bc_dict in sorted(mm_dict.items()):
+                # most common mismatches first
+                mismatched = sorted([(k, v) for k, v in bc_dict.items()
+                                        if k != o],
+                                    key=lambda kv: (-kv[1], kv[0]))
                 ret += "\t".join(map(str, [n, o, bc_dict[o],
                             "/".join(["%s (%d)" % (k, v)
-                                        for k, v in bc_dict.items()
-                                            if k != o])])) + "\n"
+                                        for k, v in mismatched])])) + "\n"
 
         if outfile != None:
             with open(outfile, "w") as outf:
@@ -342,6 +851,20 @@ class BarcodeCounter(object):
 
         return ret
 
+    def revised_barcodes(self):
+        """
+        Return a list of two dictionaries (up and down) mapping each
+        (strain, original barcode) pair to its most common barcode of the
+        same length, since a read shorter than the barcode doesn't show what
+        the rest of it is. Ties are broken in favor of the original barcode,
+        then alphabetically, so the result doesn't depend on the order reads
+        were added in
+        """
+        return [dict([((n, o), max([b for b in bc_dict if len(b) == len(o)] +
+                                   [o], key=lambda b: (bc_dict[b], b == o, b)))
+                            for (n, o), bc_dict in mm_dict.items()])
+                                for mm_dict in self.mismatches]
+
     def revised_catalog(self, outfile=None):
         """Return a string or write a file with a revised barcode catalog"""
         if self.mismatches == None:
@@ -349,15 +872,10 @@ class BarcodeCounter(object):
                             "BarcodeCounter was initialized without " +
                             "track_mismatches")
 
-        originals = [c.original for c in [self.upcache, self.downcache]]
-
-        bests = [dict([(n, max(bc_dict, key=bc_dict.get))
-                            for n, bc_dict in mm_dict.items()])
-                                for mm_dict, original_dict
-                                    in zip(self.mismatches, originals)]
+        bests = self.revised_barcodes()
 
-        ret = "\n".join(["\t".join((strain, bests[0].get(strain, up),
-                            bests[1].get(strain, dn)))
+        ret = "".join(["\t".join((strain, bests[0].get((strain, up), up),
+                            bests[1].get((strain, dn), dn))) + "\n"
                             for strain, up, dn in self.original])
 
         if outfile != None:
@@ -366,17 +884,186 @@ class BarcodeCounter(object):
 
         return ret
 
+    def revise_and_recount(self, dist):
+        """
+        Replace each barcode in the catalog with its most common version, then
+        recount all reads added so far against the revised catalog
+        """
+        if self.mismatches == None or self.reads == None:
+            raise Exception("Cannot revise and recount; BarcodeCounter " +
+                            "was initialized without track_mismatches " +
+                            "and track_reads")
+
+        # rebuild the catalog from the revised rows, as reading the revised
+        # catalog would, since strains can share a barcode
+        bests = self.revised_barcodes()
+        self.original = [(strain, bests[0].get((strain, up), up),
+                            bests[1].get((strain, dn), dn))
+                            for strain, up, dn in self.original]
+        for cache, tags in zip([self.upcache, self.downcache],
+                               self.catalog_dicts()):
+            cache.update(tags)
+
+        # reset all counts, then add each distinct read with its multiplicity
+        reads = self.reads
+        self.reads = None
+        self.reset()
+
+        for (barcode, tagcode, multiplex_code), count in reads.items():
+            self.add(barcode, tagcode, dist, multiplex_code, count=count)
+
+        self.reads = reads
+
+    def reset(self):
+        """
+        Set all counts back to zero, keeping the indexes and caches of
+        matched barcodes
+        """
+        self.total = 0
+        self.total_found = 0
+        self.block_start = 0
+        for c in self.ordered_counters:
+            c.reset()
+        if self.mismatches != None:
+            for mm_dict in self.mismatches:
+                mm_dict.clear()
+        if self.reads != None:
+            self.reads.clear()
+
+    def save_checkpoint(self, outfile, offset, reads, include_cache=False,
+                        options=None):
+        """
+        Atomically write the current counts to a binary checkpoint file, along
+        with the byte offset in the input file and the number of reads
+        processed so far. If include_cache, also save the caches of
+        barcode matches, so they don't have to be searched for again.
+
+        options can describe anything else the counts depend on, such as
+        the input file and how reads are parsed, so that load_checkpoint
+        can refuse to resume a different run.
+        """
+        state = {"offset": offset,
+                 "reads": reads,
+                 "options": options,
+                 "total": self.total,
+                 "total_found": self.total_found,
+                 "data": [dict(c.data) for c in self.ordered_counters],
+                 "mismatches": None,
+                 "read_counts": None,
+                 "caches": None}
+
+        if self.mismatches != None:
+            state["mismatches"] = [dict([(n, dict(bc_dict))
+                                        for n, bc_dict in mm_dict.items()])
+                                    for mm_dict in self.mismatches]
+        if self.reads != None:
+            state["read_counts"] = dict(self.reads)
+        if include_cache:
+            state["caches"] = [dict([(l, (c.cache_dicts, c.misses))
+                                    for l, c in cache.barcode_caches.items()])
+                                for cache in [self.upcache, self.downcache]]
+
+        # write to a temporary file first, so that a checkpoint is never left
+        # half-written
+        tmpfile = outfile + ".tmp"
+        with open(tmpfile, "wb") as outf:
+            cPickle.dump(state, outf, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmpfile, outfile)
+
+    def load_checkpoint(self, infile, options=None):
+        """
+        Restore the counts from a checkpoint file written by save_checkpoint,
+        and return the byte offset and number of reads to resume from.
+        Raise a ValueError if the checkpoint was saved with different
+        options, or by a BarcodeCounter that doesn't match this one.
+        """
+        with open(infile, "rb") as inf:
+            state = cPickle.load(inf)
+
+        if len(state["data"]) != len(self.ordered_counters):
+            raise ValueError("Checkpoint %s does not match " % infile +
+                             "this barcode and multiplex file")
+        if ((state["mismatches"] != None) != (self.mismatches != None) or
+                (state["read_counts"] != None) != (self.reads != None)):
+            raise ValueError("Checkpoint %s was not saved " % infile +
+                             "while tracking the same mismatches and reads")
+        if state["options"] != options:
+            saved, given = state["options"] or {}, options or {}
+            differ = sorted([k for k in set(saved) | set(given)
+                                if saved.get(k) != given.get(k)])
+            raise ValueError("Checkpoint %s was saved with " % infile +
+                             "different options: " + ", ".join(differ))
+
+        self.total = state["total"]
+        self.total_found = state["total_found"]
+        for c, data in zip(self.ordered_counters, state["data"]):
+            c.data.clear()
+            c.data.update(data)
+
+        if self.mismatches != None:
+            for mm_dict, saved in zip(self.mismatches, state["mismatches"]):
+                mm_dict.clear()
+                for n, bc_dict in saved.items():
+                    mm_dict[n].update(bc_dict)
+        if self.reads != None:
+            self.reads.clear()
+            self.reads.update(state["read_counts"])
+        if state["caches"] != None:
+            for cache, saved in zip([self.upcache, self.downcache],
+                                    state["caches"]):
+                for l, (cache_dicts, misses) in saved.items():
+                    cache.barcode_caches[l].restore_cache(cache_dicts, misses)
+
+        return state["offset"], state["reads"]
+
+    def end_block(self):
+        """
+        Mark the end of a block of reads sampled together, for precision (see
+        SampleCounter.end_block). Does nothing if no reads have been added
+        since the last block ended.
+        """
+        if self.total == self.block_start:
+            return
+        for c in self.ordered_counters:
+            c.end_block()
+        self.block_start = self.total
+
+    def precision(self, z=1.96, total_blocks=None):
+        """
+        Return the widest confidence interval half-width of any strain's
+        frequency within any tag and sample with barcodes counted, or None if
+        none have been, when sampling blocks out of total_blocks
+        """
+        precisions = [c.precision(z, total_blocks)
+                      for c in self.ordered_counters]
+        precisions = [p for p in precisions if p != None]
+        if len(precisions) == 0:
+            return None
+        return max(precisions)
+
     def report(self):
         """return a one-line description"""
         if self.total == 0:
             return "-"
         return "%d\t%.5f" % (self.total, float(self.total_found) / self.total)
 
+    def search_report(self, lengths=None):
+        """
+        return a one-line description of the barcode lengths probed for the
+        up and down tags, or only the first lengths probed for each (see
+        BarcodeCacheMultipleLen.report)
+        """
+        return "up %s\tdown %s" % (self.upcache.report(lengths),
+                                    self.downcache.report(lengths))
+
     def write_file(self, outfile):
         """Write to a tab-delimited table"""
+        start = timer() if self.profiler else None
         outf = open(outfile, "w")
         outf.write(str(self))
         outf.close()
+        if self.profiler:
+            self.profiler.add("output", start)
 
     def __repr__(self):
         if self.multiplexed:
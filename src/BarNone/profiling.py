@@ -0,0 +1,92 @@
+"""
+Profiler
+
+Keeps per-stage call counts, cumulative times and latency histograms, so that
+it is possible to see where the time in a run goes
+"""
+
+import math
+import json
+import collections
+from timeit import default_timer as timer
+
+
+# stages that get a latency histogram: the fuzzy matching path
+HISTOGRAM_STAGES = ("index_search", "closest_match")
+
+# stages shown in progress reports, which all of them would make too long
+PROGRESS_STAGES = ("cache_hit", "index_search")
+
+
+### FUNCTIONS ###
+
+def profile_iterator(iterator, profiler, stage="parse"):
+    """Iterate, recording the time taken to produce each item as a stage"""
+    iterator = iter(iterator)
+    while True:
+        start = timer()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        profiler.add(stage, start)
+        yield item
+
+
+### CLASSES ###
+
+class Profiler(object):
+    """Record how often each stage happens and how long it takes"""
+    def __init__(self, histogram_stages=HISTOGRAM_STAGES):
+        """
+        Given the names of the stages to keep latency histograms for. Each
+        histogram bucket is keyed by a power of two of microseconds, and counts
+        the calls that took at most that long.
+        """
+        self.counts = collections.defaultdict(int)
+        self.times = collections.defaultdict(float)
+        self.histograms = dict([(s, collections.defaultdict(int))
+                                    for s in histogram_stages])
+        self.start = timer()
+
+    def add(self, stage, start=None, count=1):
+        """
+        Count one call of a stage (or count calls). If given the time at
+        which it started, also add its duration to the cumulative time (and
+        histogram)
+        """
+        self.counts[stage] += count
+        if start == None:
+            return
+
+        elapsed = timer() - start
+        self.times[stage] += elapsed
+
+        if stage in self.histograms:
+            microseconds = elapsed * 1e6
+            bucket = (2 ** int(math.ceil(math.log(microseconds, 2)))
+                        if microseconds > 1 else 1)
+            self.histograms[stage][bucket] += 1
+
+    def as_dict(self):
+        """Return a dictionary of all recorded statistics"""
+        return {"elapsed": timer() - self.start,
+                "counts": dict(self.counts),
+                "times": dict(self.times),
+                "histograms": dict([(s, dict([(str(b), n)
+                                                for b, n in sorted(h.items())]))
+                                    for s, h in self.histograms.items()])}
+
+    def report(self, stages=None):
+        """
+        return a one-line description of the counts of each stage, or only of
+        the given stages
+        """
+        return "\t".join(["%s=%d" % (s, n)
+                            for s, n in sorted(self.counts.items())
+                                if stages == None or s in stages])
+
+    def write_file(self, outfile):
+        """Write all statistics to a JSON file"""
+        with open(outfile, "w") as outf:
+            json.dump(self.as_dict(), outf, indent=2, sort_keys=True)
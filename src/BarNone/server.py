@@ -0,0 +1,203 @@
+"""
+Server
+
+Keeps barcode catalogs, with their indexes and caches of matched barcodes,
+resident in a long-running process that counts batches of reads sent to it
+over a Unix socket. Each request and response is one line of JSON.
+"""
+
+import os
+import json
+import stat
+import shutil
+import socket
+import tempfile
+import threading
+import SocketServer
+
+from BarNone import matching
+
+
+# the same defaults as the BarNone script
+DEFAULTS = {"uptag": "TCT", "downtag": "TAG", "multiplexfile": None,
+            "mismatches": 3, "start": 4, "length": 20, "tagstart": 1,
+            "taglength": 3, "multiplexstart": 1, "multiplexlength": 6,
+            "assignments": False}
+
+# a long-running server sees ever more distinct reads, so by default it
+# caches at most this many inexact matches (and misses) for each length
+DEFAULT_CACHE_SIZE = 100000
+
+
+### FUNCTIONS ###
+
+def request(socket_file, message):
+    """
+    Send a request (a dictionary) to the server listening on socket_file, and
+    return its response
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_file)
+    try:
+        f = sock.makefile("rw")
+        f.write(json.dumps(message) + "\n")
+        f.flush()
+        response = json.loads(f.readline())
+        f.close()
+    finally:
+        sock.close()
+
+    if "error" in response:
+        raise Exception("BarNone server error: " + response["error"])
+
+    return response
+
+
+### CLASSES ###
+
+class CounterPool(object):
+    """Resident BarcodeCounters, one for each catalog and set of tags"""
+    def __init__(self, index="simple", index_dir=None,
+                 cache_size=DEFAULT_CACHE_SIZE):
+        """
+        Given the index and cache_size of each BarcodeCounter (see
+        BarcodeCache). A "disk" index for each counter is stored in its own
+        temporary directory, within index_dir if it is given.
+        """
+        if index not in matching.INDEXES:
+            raise ValueError("Unknown index type %s" % index)
+        self.index = index
+        self.index_dir = index_dir
+        self.cache_size = cache_size
+
+        # each maps (catalog, uptag, downtag, multiplex_file) to the
+        # modification times of the files, the counter built from them and
+        # the directory of its index, and to the lock that must be held while
+        # building or using it
+        self.counters = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, catalog, uptag, downtag, multiplex_file=None):
+        """
+        Return a BarcodeCounter and the lock that must be held while using it,
+        building it if this catalog hasn't been seen (or has changed) since
+        """
+        key = (catalog, uptag, downtag, multiplex_file)
+        mtimes = (os.path.getmtime(catalog),
+                  os.path.getmtime(multiplex_file) if multiplex_file else None)
+
+        with self.lock:
+            if key not in self.locks:
+                self.locks[key] = threading.Lock()
+            lock = self.locks[key]
+
+        # build while holding only this catalog's lock, so requests for other
+        # catalogs don't wait for it
+        with lock:
+            if key not in self.counters or self.counters[key][0] != mtimes:
+                # replaces any counter built before the files changed
+                self.remove_index(key)
+                index_dir = (tempfile.mkdtemp(dir=self.index_dir)
+                                if self.index == "disk" else None)
+                self.counters[key] = (mtimes,
+                                      matching.BarcodeCounter(catalog, uptag,
+                                            downtag, multiplex_file,
+                                            index=self.index,
+                                            index_dir=index_dir,
+                                            cache_size=self.cache_size),
+                                      index_dir)
+            return self.counters[key][1], lock
+
+    def remove_index(self, key):
+        """Remove the directory of the index of a counter, if it has one"""
+        if key in self.counters and self.counters[key][2] != None:
+            shutil.rmtree(self.counters[key][2], ignore_errors=True)
+
+    def close(self):
+        """Remove the directories of all disk-based indexes"""
+        with self.lock:
+            for key in self.counters:
+                self.remove_index(key)
+
+    def count(self, message):
+        """
+        Count the reads in a request. Along with "catalog" and "reads" (a list
+        of read sequences), a request can give any of the keys in DEFAULTS,
+        which correspond to the options of the BarNone script.
+        """
+        options = dict(DEFAULTS)
+        options.update(message)
+
+        barcode_start = options["start"] - 1
+        barcode_end = barcode_start + options["length"]
+        tag_start = options["tagstart"] - 1
+        tag_end = tag_start + options["taglength"]
+        multiplex_start = options["multiplexstart"] - 1
+        multiplex_end = multiplex_start + options["multiplexlength"]
+
+        counter, lock = self.get(options["catalog"], options["uptag"],
+                                 options["downtag"], options["multiplexfile"])
+
+        assignments = []
+        with lock:
+            counter.reset()
+            for l in options["reads"]:
+                l = str(l)
+                if counter.multiplexed:
+                    multiplex_code = l[multiplex_start:multiplex_end]
+                else:
+                    multiplex_code = None
+                found = counter.add(l[barcode_start:barcode_end],
+                                    l[tag_start:tag_end],
+                                    options["mismatches"], multiplex_code)
+                if options["assignments"]:
+                    assignments.append(list(found[:2]) if found else None)
+
+            if counter.multiplexed:
+                names = [c.name for c in counter.ordered_counters]
+            else:
+                names = ["UP", "DOWN"]
+
+            ret = {"total": counter.total,
+                   "found": counter.total_found,
+                   "counts": dict([(n, dict(c.data)) for n, c in
+                                    zip(names, counter.ordered_counters)])}
+
+        if options["assignments"]:
+            ret["assignments"] = assignments
+        return ret
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    """Answer each line of JSON sent over a connection"""
+    def handle(self):
+        for l in self.rfile:
+            try:
+                response = self.server.pool.count(json.loads(l))
+            except Exception, e:
+                response = {"error": "%s: %s" % (e.__class__.__name__, e)}
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Serve counting requests on a Unix socket, handling each connection in its
+    own thread. Requests for the same catalog take turns, since they share
+    caches. Counting holds the interpreter lock (flamingo's indexes share
+    state, so can't search in parallel), so requests for different catalogs
+    are interleaved rather than counted in parallel.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_file, pool=None):
+        if os.path.lexists(socket_file):
+            # replace a socket left by an earlier server, but nothing else
+            if not stat.S_ISSOCK(os.lstat(socket_file).st_mode):
+                raise ValueError("%s exists and is not a socket" %
+                                    socket_file)
+            os.remove(socket_file)
+        self.pool = pool if pool != None else CounterPool()
+        SocketServer.UnixStreamServer.__init__(self, socket_file,
+                                               RequestHandler)
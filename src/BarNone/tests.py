@@ -7,8 +7,13 @@ import itertools
 import unittest
 import random
 import shutil
+import json
+import threading
 
 from BarNone import matching
+from BarNone import profiling
+from BarNone import benchmark
+from BarNone import server
 import flamingo
 
 NUCLEOTIDES = "ACGT"
@@ -83,6 +88,21 @@ class TestFlamingo(unittest.TestCase):
         self.assertEqual(flamingo.distance("A", "AAA"), 2)
         self.assertEqual(flamingo.distance("apple", "applesauce"), 5)
 
+    def test_insert_remove(self):
+        """Test changing the contents of an index after it is built"""
+        words = ["apple", "banana", "orange"]
+        indexer = flamingo.WrapperSimpleEd(words)
+        indexer.remove("apple")
+        self.check_search(indexer, "apple", [], 1)
+        indexer.insert("aaple")
+        self.check_search(indexer, "apple", ["aaple"], 1)
+        self.check_search(indexer, "banana", ["banana"], 0)
+        self.assertRaises(KeyError, indexer.remove, "apple")
+        # strings inserted after building can be removed too
+        indexer.remove("aaple")
+        self.check_search(indexer, "apple", [], 1)
+        self.assertRaises(KeyError, indexer.remove, "aaple")
+
 #     def test_time_distance(self):
 #         """Time the flamingo.distance function"""
 #         import timeit
@@ -123,6 +143,15 @@ class TestBarcodeCache(unittest.TestCase):
             self.assertEqual(cache.total_cached, t_cached)
             self.assertEqual(cache.total_looked_up, t_looked_up)
 
+        # a full cache forgets only its oldest match, and misses are kept
+        # separately
+        cache = matching.BarcodeCache(dict([(w, w) for w in words]),
+                                      cache_size=2)
+        for query in ["ACGA", "CCGA", "GCGA", "TTTTTTTT"]:
+            cache.search(query, 1)
+        self.assertEqual(cache.cache_dicts[False].keys(), ["CCGA", "GCGA"])
+        self.assertEqual(cache.misses.keys(), ["TTTTTTTT"])
+
     def test_barcode_cache_multiple_len(self):
         """basic tests of BarcodeCacheMultipleLen"""
         words = list(itertools.chain(*[[l * 5, l * 6]
@@ -183,6 +212,73 @@ class TestBarcodeCache(unittest.TestCase):
         self.assertEqual(cache.search("AAAAA", 1, details=True),
                             ("BAAAA", "BAAAA", 5))
 
+    def test_length_stats(self):
+        """
+        Lengths that can't give the best match are skipped, and the lengths
+        that do are probed first
+        """
+        words = ["AAAAA", "CCCCC", "GGGGG", "TTTTTTTTT"]
+        cache = matching.BarcodeCacheMultipleLen(dict([(w, w) for w in words]))
+        self.assertEqual(cache.probe_order, [5, 9])
+
+        self.assertEqual(cache.search("AAAAC", 3), "AAAAA")
+        self.assertEqual(cache.length_stats[5]["wins"], 1)
+        self.assertEqual(cache.length_stats[9]["skipped"], 1)
+        self.assertEqual(cache.length_stats[9]["probes"], 0)
+
+        # with no match of length five, nine must be searched
+        self.assertEqual(cache.search("TTTTTTTTA", 1), "TTTTTTTTT")
+        self.assertEqual(cache.length_stats[9]["probes"], 1)
+
+        for i in range(5):
+            cache.search("TTTTTTTAT", 2)
+        cache.reorder()
+        self.assertEqual(cache.probe_order, [9, 5])
+        self.assertEqual(cache.report(), "9:6/6 5:1/7")
+        self.assertEqual(cache.report(1), "9:6/6")
+        # probes are only timed when profiling
+        self.assertEqual(cache.length_stats[9]["seconds"], 0)
+        cache.profiler = profiling.Profiler()
+        cache.search("TTTTTTTAT", 2)
+        self.assertTrue(cache.length_stats[9]["seconds"] > 0)
+
+    def test_index_types(self):
+        """Compressed and disk-based indexes match like the simple index"""
+        catalog = list(set([random_barcode(9) for i in range(1000)] +
+                           [random_barcode(10) for i in range(1000)]))
+        barcode_dict = dict([(w, w) for w in catalog])
+        queries = [random_barcode(random.choice([9, 10])) for i in range(100)]
+
+        simple = matching.BarcodeCacheMultipleLen(barcode_dict)
+        expected = [simple.search(q, 3, details=True) for q in queries]
+
+        index_dir = "test_index_directory"
+        try:
+            for index in ["discard", "combine", "disk"]:
+                cache = matching.BarcodeCacheMultipleLen(barcode_dict,
+                                            index=index, index_dir=index_dir,
+                                            cache_size=10)
+                self.assertEqual([cache.search(q, 3, details=True)
+                                    for q in queries], expected)
+                for c in cache.barcode_caches.values():
+                    self.assertTrue(len(c.cache_dicts[True]) <= 10)
+                    self.assertTrue(len(c.misses) <= 10)
+        finally:
+            shutil.rmtree(index_dir)
+
+        self.assertRaises(ValueError, matching.BarcodeCache, barcode_dict,
+                          index="disk")
+
+    def test_repeated_values(self):
+        """Several barcodes mapping to the same value are all matched"""
+        cache = matching.BarcodeCache({"AAAAA": "x", "CCCCC": "x"})
+        for i in range(2):
+            for barcode, query in [("AAAAA", "AAAAA"), ("CCCCC", "CCCCC"),
+                                   ("AAAAA", "AAAAT"), ("CCCCC", "CCCCT")]:
+                self.assertEqual(cache.search(query, 1), "x")
+                self.assertEqual(cache.search(query, 1, details=True),
+                                 ("x", barcode))
+
 
 class TestBarcodeCounter(unittest.TestCase):
     """
@@ -204,6 +300,16 @@ class TestBarcodeCounter(unittest.TestCase):
         os.chdir(self.original_directory)
         shutil.rmtree(self.test_directory)
 
+    def write_random_catalog(self, strains, length):
+        """
+        Write a catalog of the given number of strains, with random up and
+        down barcodes of the given length, to the test file
+        """
+        with open(self.test_file, "w") as outf:
+            for i in range(strains):
+                outf.write("\t".join(["s%d" % i, random_barcode(length),
+                                      random_barcode(length)]) + "\n")
+
     def test_barcode_counter(self):
         """Simple tests of barcode counter"""
         names = list("0123456789")
@@ -222,17 +328,17 @@ class TestBarcodeCounter(unittest.TestCase):
                                          track_mismatches=True)
 
         for n, u, d in zip(names, uptags, dntags):
-            self.assertEqual(counter.mismatches[0][n][u], 0)
+            self.assertEqual(counter.mismatches[0][(n, u)][u], 0)
             # add one uptag
             self.assertEqual(counter.add(u, "UPT", 0), (n, u, len(u)))
-            self.assertEqual(counter.mismatches[0][n][u], 1)
+            self.assertEqual(counter.mismatches[0][(n, u)][u], 1)
 
             self.assertEqual(counter.add(u + "Q", "UPT", 1), (n, u, len(u)))
 
             # add close ones
             if len(u) == 5:
                 self.assertEqual(counter.add(u[:4], "UPT", 1), (n, u, 5))
-                self.assertEqual(counter.mismatches[0][n][u[:4]], 1)
+                self.assertEqual(counter.mismatches[0][(n, u)][u[:4]], 1)
 
         # basic checks of mismatch table
         mm_table = [l[:-1].split("\t")
@@ -282,6 +388,381 @@ class TestBarcodeCounter(unittest.TestCase):
         self.assertTrue("_apple\taaple\tapple" in
                             counter.revised_catalog().split("\n"))
 
+        # a read too short to show the whole barcode can't revise it
+        for i in range(10):
+            self.assertEqual(counter.add("banan", "UPT", 1),
+                                ("_banana", "banana", 6))
+
+        self.assertTrue("_banana\tbanana\tbanana" in
+                            counter.revised_catalog().split("\n"))
+
+    def test_revise_and_recount(self):
+        """Recounting should match a second run on the revised catalog"""
+        catalog = list(set([random_barcode(9) for i in range(200)] +
+                           [random_barcode(10) for i in range(20)]))
+        unique_rows = [("s%d" % i, b, b) for i, b in enumerate(catalog)]
+        # names that are repeated, both with barcodes of different lengths and
+        # with barcodes of the same length
+        repeated_rows = [("r%d" % (i % 15), b, b)
+                            for i, b in enumerate(catalog)]
+        # pairs of strains that share a downtag
+        shared_rows = [("s%d" % i, b, catalog[i - i % 2])
+                            for i, b in enumerate(catalog)]
+
+        reads = []
+        for i in range(3000):
+            b = random.choice(catalog)
+            if random.random() < .5:
+                # consistently mutate the first base of some barcodes
+                b = ("A" if b[0] != "A" else "C") + b[1:]
+            b = "".join([random.choice(NUCLEOTIDES)
+                            if random.random() < .05 else c for c in b])
+            reads.append((b, random.choice(["UPT", "DNT"])))
+
+        for rows in [unique_rows, repeated_rows, shared_rows]:
+            with open(self.test_file, "w") as outf:
+                for r in rows:
+                    outf.write("\t".join(r) + "\n")
+
+            counter = matching.BarcodeCounter(self.test_file, "UPT", "DNT",
+                                              track_mismatches=True,
+                                              track_reads=True)
+            for b, t in reads:
+                counter.add(b, t, 2)
+
+            revised = counter.revised_catalog()
+            with open("revised.txt", "w") as outf:
+                outf.write(revised)
+            counter.revise_and_recount(2)
+
+            # each barcode is revised on its own, even if its name repeats
+            self.assertEqual(len(set(revised.split("\n"))),
+                             len(catalog) + 1)
+            if rows is not shared_rows:
+                # revising again changes nothing, unless a strain that
+                # shared a revised barcode now has it to itself
+                self.assertEqual(revised, counter.revised_catalog())
+
+            second = matching.BarcodeCounter("revised.txt", "UPT", "DNT",
+                                             track_mismatches=True)
+            for b, t in reads:
+                second.add(b, t, 2)
+
+            self.assertEqual(sorted(str(counter).split("\n")),
+                             sorted(str(second).split("\n")))
+            self.assertEqual(counter.report(), second.report())
+            self.assertEqual(counter.mismatch_table(), second.mismatch_table())
+            self.assertEqual(counter.revised_catalog(),
+                             second.revised_catalog())
+
+    def test_profiler(self):
+        """Check that each stage is recorded in the Profiler"""
+        words = ["apple", "banana", "orange"]
+        with open(self.test_file, "w") as outf:
+            for w in words:
+                outf.write("\t".join(["_" + w, w, w]) + "\n")
+
+        profiler = profiling.Profiler()
+        counter = matching.BarcodeCounter(self.test_file, "UPT", "DNT",
+                                          profiler=profiler)
+        reads = ["UPTapple", "UPTaple", "UPTaple", "DNTqqqqq", "DNTqqqqq"]
+        for r in profiling.profile_iterator(reads, profiler):
+            counter.add(r[3:], r[:3], 1)
+        counter.write_file("counts.txt")
+
+        self.assertEqual(profiler.counts["parse"], 5)
+        self.assertEqual(profiler.counts["tag_decode"], 5)
+        self.assertEqual(profiler.counts["exact_hit"], 1)
+        self.assertEqual(profiler.counts["cache_hit"], 1)
+        # only the first of each read is searched for in the index; the
+        # second "aple" misses at length 6 again before matching at length 5
+        self.assertEqual(profiler.counts["cache_negative_hit"], 3)
+        self.assertEqual(profiler.counts["index_search"], 4)
+        self.assertEqual(profiler.counts["output"], 1)
+        self.assertEqual(sum(profiler.histograms["index_search"].values()),
+                         4)
+
+        profiler.write_file("stats.json")
+        with open("stats.json") as inf:
+            self.assertEqual(json.load(inf)["counts"]["parse"], 5)
+        self.assertEqual(profiler.report(["index_search", "output"]),
+                         "index_search=4\toutput=1")
+
+        # a barcode missing from the index is only searched for again with a
+        # larger distance
+        profiler = profiling.Profiler()
+        cache = matching.BarcodeCache(dict([(w, w) for w in words]),
+                                      profiler=profiler)
+        for d in [1, 1, 1, 2]:
+            self.assertEqual(cache.search("qqqqq", d), None)
+        self.assertEqual(profiler.counts["index_search"], 2)
+        self.assertEqual(profiler.counts["cache_negative_hit"], 2)
+        self.assertEqual(cache.search("aaple", 0), None)
+        self.assertEqual(cache.search("aaple", 1), "apple")
+        # a cached match that is too far isn't a hit
+        self.assertEqual(cache.search("aaple", 0), None)
+        self.assertEqual(profiler.counts["cache_hit"], 0)
+        self.assertEqual(profiler.counts["cache_negative_hit"], 3)
+
+    def test_simulate(self):
+        """Error-free simulated runs should be counted exactly"""
+        self.write_random_catalog(50, 20)
+
+        for format, samples in [("fastq", 0), ("fasta", 0), ("qseq", 2),
+                                ("txt", 3)]:
+            sim = benchmark.simulate(self.test_file, format, 500, format,
+                                     substitution=0, insertion=0,
+                                     deletion=0, n_rate=0, samples=samples,
+                                     mixed_lengths=.2)
+            self.assertEqual(sum(sim["truth"].values()), 500)
+
+            result = benchmark.benchmark_counter(sim, mismatches=0)
+            self.assertEqual(result["reads"], 500)
+            self.assertEqual(result["found"], 500)
+            self.assertEqual(result["cache"]["exact_hits"], 500)
+
+            result = benchmark.benchmark_counter(sim, mismatches=0,
+                                                 profile=False)
+            self.assertEqual(result["found"], 500)
+            self.assertEqual(result["cache"], None)
+
+            result = benchmark.benchmark_counter(sim, mismatches=0,
+                                                 native=True)
+            self.assertEqual(result["found"], 500)
+            self.assertEqual(result["native"], samples == 0)
+
+    def test_count_native(self):
+        """Counting within flamingo should match counting in Python"""
+        self.write_random_catalog(50, 20)
+
+        for format in benchmark.ITERATORS:
+            sim = benchmark.simulate(self.test_file, format, 2000, format,
+                                     substitution=.05, insertion=.01,
+                                     deletion=.01, n_rate=.01,
+                                     mixed_lengths=.2, downtag="TCG")
+            # barcodes run past the end of some reads
+            start, end = 3, 3 + 25
+
+            python = matching.BarcodeCounter(sim["catalog"], "TCT", "TCG")
+            for l in benchmark.ITERATORS[format](sim["reads"]):
+                python.add(l[start:end], l[:3], 2)
+
+            native = matching.BarcodeCounter(sim["catalog"], "TCT", "TCG")
+            self.assertTrue(native.native_supported())
+            native.count_native(sim["reads"], format, start, end, 0, 3, 2)
+
+            self.assertEqual(native.total, python.total)
+            self.assertEqual(native.total_found, python.total_found)
+            for n, p in zip(native.counter, python.counter):
+                self.assertEqual(dict(n.data), dict(p.data))
+
+            native = matching.BarcodeCounter(sim["catalog"], "TCT", "TCG")
+            native.count_native(sim["reads"], format, start, end, 0, 3, 2,
+                                n=100)
+            self.assertEqual(native.total, 100)
+
+            # a Profiler records the reads and the time spent in flamingo
+            profiler = profiling.Profiler()
+            native = matching.BarcodeCounter(sim["catalog"], "TCT", "TCG",
+                                             profiler=profiler)
+            self.assertTrue(native.native_supported())
+            native.count_native(sim["reads"], format, start, end, 0, 3, 2)
+            self.assertEqual(native.total_found, python.total_found)
+            self.assertEqual(profiler.counts["parse"], python.total)
+            self.assertEqual(profiler.counts["count_native"], 1)
+
+        counter = matching.BarcodeCounter(self.test_file, "TCT", "TAG",
+                                          track_mismatches=True)
+        self.assertFalse(counter.native_supported())
+        self.assertRaises(ValueError, counter.count_native, sim["reads"],
+                          "txt", start, end, 0, 3, 2)
+
+    def test_sampling(self):
+        """
+        Blocks in a random order cover every read once, and precision
+        improves with more reads
+        """
+        self.write_random_catalog(20, 20)
+
+        for format in benchmark.ITERATORS:
+            sim = benchmark.simulate(self.test_file, format, 1000, format,
+                                     samples=(2 if format == "qseq" else 0))
+            expected = sorted(benchmark.ITERATORS[format](sim["reads"]))
+            for block_size in [1, 50, 1000, 10 ** 6]:
+                blocks = list(matching.iterate_blocks(sim["reads"], format,
+                                                      block_size, seed=1))
+                self.assertEqual(sorted([l for b, l in blocks]), expected)
+                # blocks are visited one at a time
+                visited = [b for b, l in blocks]
+                self.assertEqual(visited, sorted(visited))
+
+        counter = matching.BarcodeCounter(sim["catalog"], "TCT", "TAG")
+        self.assertEqual(counter.precision(), None)
+
+        precisions = []
+        for i, l in enumerate(benchmark.ITERATORS["fastq"](
+                                os.path.join("fastq", "reads.fastq"))):
+            counter.add(l[3:23], l[:3], 1)
+            if i % 250 == 249:
+                precisions.append(counter.precision())
+        self.assertEqual(precisions, sorted(precisions, reverse=True))
+        self.assertTrue(0 < precisions[-1] < .1)
+
+        # blocks that each contain a single strain are much less precise
+        # than blocks that each contain an even mix
+        uptags = [l[:-1].split("\t")[1] for l in open(sim["catalog"])]
+        for mixed, low, high in [(True, 0, .05), (False, .3, 1)]:
+            counter = matching.BarcodeCounter(sim["catalog"], "TCT", "TAG")
+            for i in range(10):
+                for j in range(100):
+                    counter.add(uptags[(i + j) % 2 if mixed else i % 2],
+                                "TCT", 1)
+                counter.end_block()
+            counter.end_block()
+            self.assertEqual(counter.counter[0].blocks, 10)
+            self.assertTrue(low < counter.counter[0].precision() < high)
+            # having sampled every block, only the Wilson interval is left
+            self.assertTrue(counter.counter[0].precision(total_blocks=10) <=
+                            counter.counter[0].precision())
+            self.assertTrue(counter.precision(total_blocks=10) < .05)
+
+    def test_checkpoint(self):
+        """Resuming from a checkpoint should give the same results"""
+        self.write_random_catalog(50, 12)
+
+        for format in ["fastq", "fasta", "qseq", "txt"]:
+            sim = benchmark.simulate(self.test_file, format, 300, format,
+                                     substitution=.05)
+            reads = list(matching.iterate_offsets(sim["reads"], format))
+            self.assertEqual([l for o, l in reads],
+                list(benchmark.ITERATORS[format](sim["reads"])))
+            self.assertEqual(list(matching.iterate_offsets(sim["reads"],
+                                                format, reads[99][0])),
+                             reads[100:])
+
+        def add_all(counter, reads):
+            for o, l in reads:
+                counter.add(l[3:15], l[:3], 2)
+
+        uninterrupted = matching.BarcodeCounter(sim["catalog"], "TCT", "TAG",
+                                                track_mismatches=True)
+        add_all(uninterrupted, reads)
+
+        # the cache can be saved and resumed with different bounds
+        for include_cache, saved_size, resumed_size in [(True, None, None),
+                                                        (True, None, 5),
+                                                        (True, 5, None),
+                                                        (False, None, None)]:
+            first = matching.BarcodeCounter(sim["catalog"], "TCT", "TAG",
+                                            track_mismatches=True,
+                                            cache_size=saved_size)
+            add_all(first, reads[:100])
+            first.save_checkpoint("checkpoint", reads[99][0], 100,
+                                  include_cache)
+
+            resumed = matching.BarcodeCounter(sim["catalog"], "TCT", "TAG",
+                                              track_mismatches=True,
+                                              cache_size=resumed_size)
+            offset, n = resumed.load_checkpoint("checkpoint")
+            self.assertEqual((offset, n), (reads[99][0], 100))
+            for l, c in resumed.upcache.barcode_caches.items():
+                saved = first.upcache.barcode_caches[l]
+                saved_sizes = [len(d) for d in
+                                saved.cache_dicts.values() + [saved.misses]]
+                sizes = [len(d) for d in c.cache_dicts.values() + [c.misses]]
+                if saved_size == None:
+                    self.assertTrue(max(saved_sizes) > 5)
+                if resumed_size != None:
+                    self.assertTrue(max(sizes) <= resumed_size)
+                elif include_cache:
+                    self.assertEqual(sizes, saved_sizes)
+            add_all(resumed, matching.iterate_offsets(sim["reads"], "txt",
+                                                      offset))
+
+            self.assertEqual(str(resumed), str(uninterrupted))
+            self.assertEqual(resumed.report(), uninterrupted.report())
+            self.assertEqual(resumed.mismatch_table(),
+                             uninterrupted.mismatch_table())
+
+        # refuse to resume a run with different options or tracking
+        first.save_checkpoint("checkpoint", reads[99][0], 100,
+                              options={"mismatches": 2, "format": "txt"})
+        self.assertEqual(first.load_checkpoint("checkpoint",
+                                    {"mismatches": 2, "format": "txt"}),
+                         (reads[99][0], 100))
+        for options in [None, {"mismatches": 3, "format": "txt"},
+                        {"mismatches": 2}]:
+            self.assertRaises(ValueError, first.load_checkpoint,
+                              "checkpoint", options)
+        untracked = matching.BarcodeCounter(sim["catalog"], "TCT", "TAG")
+        self.assertRaises(ValueError, untracked.load_checkpoint, "checkpoint",
+                          {"mismatches": 2, "format": "txt"})
+
+    def test_server(self):
+        """Counts from the server should match a BarcodeCounter's"""
+        self.write_random_catalog(50, 12)
+        sim = benchmark.simulate(self.test_file, "sim", 300, "txt",
+                                 substitution=.05)
+        reads = list(matching.iterate_txt(sim["reads"]))
+
+        # counters with a disk index and a small cache still count the same
+        os.mkdir("indexes")
+        pool = server.CounterPool("disk", "indexes", 5)
+        s = server.Server(os.path.abspath("socket"), pool)
+        t = threading.Thread(target=s.serve_forever)
+        t.daemon = True
+        t.start()
+
+        try:
+            counter = matching.BarcodeCounter(sim["catalog"], "TCT", "TAG")
+            found = [counter.add(l[3:15], l[:3], 2) for l in reads]
+
+            # send twice, to check that counts are reset between requests
+            for i in range(2):
+                response = server.request("socket",
+                                          {"catalog": sim["catalog"],
+                                           "reads": reads, "mismatches": 2,
+                                           "start": 4, "length": 12,
+                                           "assignments": True})
+                self.assertEqual(response["total"], counter.total)
+                self.assertEqual(response["found"], counter.total_found)
+                self.assertEqual(response["counts"]["UP"],
+                                 dict(counter.counter[0].data))
+                self.assertEqual(response["counts"]["DOWN"],
+                                 dict(counter.counter[1].data))
+                self.assertEqual(response["assignments"],
+                                 [list(f[:2]) if f else None for f in found])
+            for c in (pool.counters.values()[0][1].upcache
+                        .barcode_caches.values()):
+                self.assertTrue(len(c.misses) <= 5)
+                self.assertTrue(len(c.cache_dicts[True]) <= 5)
+
+            self.assertRaises(Exception, server.request, "socket",
+                              {"catalog": "nonexistent.txt", "reads": []})
+
+            # a changed catalog replaces the counter built from it
+            os.utime(sim["catalog"], (0, 0))
+            response = server.request("socket", {"catalog": sim["catalog"],
+                                                 "reads": reads})
+            self.assertEqual(len(s.pool.counters), 1)
+            # along with the directory of its index
+            self.assertEqual(len(os.listdir("indexes")), 1)
+        finally:
+            s.shutdown()
+            s.server_close()
+            pool.close()
+        self.assertEqual(os.listdir("indexes"), [])
+
+        # an existing socket is replaced, but not any other file
+        s = server.Server(os.path.abspath("socket"))
+        s.server_close()
+        os.remove("socket")
+        with open("socket", "w") as outf:
+            outf.write("not a socket")
+        self.assertRaises(ValueError, server.Server,
+                          os.path.abspath("socket"))
+        self.assertTrue(os.path.isfile("socket"))
+
 
 def run_tests():
     unittest.main()
@@ -8,6 +8,8 @@
 #include <algorithm>
 #include <iterator>
 #include <vector>
+#include <tr1/unordered_map>
+#include <tr1/unordered_set>
 
 #include <ctype.h>
 #include <stdio.h>
@@ -28,6 +30,47 @@ typedef struct {
     WrapperSimpleEd * index;
 } flamingo_WrapperSimpleEd;
 
+/* in-memory index whose inverted lists are compressed by discarding some */
+typedef struct {
+    PyObject_HEAD
+    GramGenFixedLen * gramGen;
+    StringContainerVector * strContainer;
+    WrapperDiscardListsLLFEd * index;
+} flamingo_WrapperDiscardListsEd;
+
+/* in-memory index whose inverted lists are compressed by combining some */
+typedef struct {
+    PyObject_HEAD
+    GramGenFixedLen * gramGen;
+    StringContainerVector * strContainer;
+    WrapperCombineListsBasicEd * index;
+} flamingo_WrapperCombineListsEd;
+
+/* index whose strings and inverted lists are kept on disk */
+typedef struct {
+    PyObject_HEAD
+    GramGenFixedLen * gramGen;
+    StringContainerRM * strContainer;
+    WrapperOnDiskSimpleEd * index;
+} flamingo_WrapperOnDiskEd;
+
+
+/* copy a Python list of strings into a vector, returning false on error */
+static bool parse_string_list(PyObject * listObj, vector<string> & barcodes)
+{
+    int numLines = PyList_Size(listObj);
+    if (numLines < 0)
+        return false; /* Not a list */
+
+    for (int i=0; i<numLines; i++) {
+        char * line = PyString_AsString(PyList_GetItem(listObj, i));
+        if (line == NULL)
+            return false;
+        barcodes.push_back(line);
+    }
+    return true;
+}
+
 
 static int WrapperSimpleEd_init(flamingo_WrapperSimpleEd *self, PyObject *args, PyObject *kwds)
 {
@@ -67,8 +110,102 @@ static int WrapperSimpleEd_init(flamingo_WrapperSimpleEd *self, PyObject *args,
     return 0;
 }
 
+static int WrapperDiscardListsEd_init(flamingo_WrapperDiscardListsEd *self, PyObject *args, PyObject *kwds)
+{
+    PyObject * listObj;
+    float compressionRatio = 0.5;
+    if (! PyArg_ParseTuple(args, "O!|f", &PyList_Type, &listObj,
+                           &compressionRatio))
+        return -1;
+
+    vector<string> barcodes;
+    if (!parse_string_list(listObj, barcodes))
+        return -1;
+
+    self->gramGen = new GramGenFixedLen(2);
+    self->strContainer = new StringContainerVector(true);
+    self->strContainer->initStatsCollector(self->gramGen);
+    self->strContainer->fillContainer(barcodes.begin(), barcodes.end());
+    self->index = new WrapperDiscardListsLLFEd(self->strContainer, 2, true,
+                                               compressionRatio);
+    self->index->buildIndex();
+    return 0;
+}
+
+static int WrapperCombineListsEd_init(flamingo_WrapperCombineListsEd *self, PyObject *args, PyObject *kwds)
+{
+    PyObject * listObj;
+    float compressionRatio = 0.5;
+    if (! PyArg_ParseTuple(args, "O!|f", &PyList_Type, &listObj,
+                           &compressionRatio))
+        return -1;
+
+    vector<string> barcodes;
+    if (!parse_string_list(listObj, barcodes))
+        return -1;
+
+    /* the lists to combine are chosen from a 10% sample of the strings */
+    if (barcodes.size() < 10) {
+        PyErr_SetString(PyExc_ValueError,
+                        "combining lists needs at least 10 strings");
+        return -1;
+    }
+
+    self->gramGen = new GramGenFixedLen(2);
+    self->strContainer = new StringContainerVector(true);
+    self->strContainer->initStatsCollector(self->gramGen);
+    self->strContainer->fillContainer(barcodes.begin(), barcodes.end());
+    self->index = new WrapperCombineListsBasicEd(self->strContainer, 2, true,
+                                                 compressionRatio);
+    self->index->buildIndex();
+    return 0;
+}
+
+static int WrapperOnDiskEd_init(flamingo_WrapperOnDiskEd *self, PyObject *args, PyObject *kwds)
+{
+    PyObject * listObj;
+    const char * directory;
+    if (! PyArg_ParseTuple(args, "O!s", &PyList_Type, &listObj, &directory))
+        return -1;
+
+    vector<string> barcodes;
+    if (!parse_string_list(listObj, barcodes))
+        return -1;
+
+    /* give flamingo absolute paths, rather than changing the working
+       directory of the whole process. The files stay open afterwards */
+    string prefix = string(directory) + "/";
+    if (directory[0] != '/') {
+        char cwd[4096];
+        if (getcwd(cwd, sizeof(cwd)) == NULL) {
+            PyErr_SetFromErrno(PyExc_OSError);
+            return -1;
+        }
+        prefix = string(cwd) + "/" + prefix;
+    }
+
+    try {
+        self->gramGen = new GramGenFixedLen(2);
+        self->strContainer = new StringContainerRM(true);
+        self->strContainer->initStatsCollector(self->gramGen);
+        self->strContainer->createAndOpen((prefix + "strings.rm").c_str());
+        self->strContainer->fillContainer(barcodes.begin(), barcodes.end());
+        self->index = new WrapperOnDiskSimpleEd(self->strContainer,
+                                                prefix + "invlists.ix", 2,
+                                                true, true);
+        self->index->buildIndex();
+    }
+    catch (std::exception & e) {
+        PyErr_SetString(PyExc_RuntimeError, e.what());
+        return -1;
+    }
+    return 0;
+}
+
+/* search any of the index types, which all have a strContainer and index */
+template <class IndexObject>
 static PyObject *
-WrapperSimpleEd_search(flamingo_WrapperSimpleEd* self, PyObject *args) {
+index_search(IndexObject* self, PyObject *args) {
     const char * query;
     float editDistance;
     if (!PyArg_ParseTuple(args, "sf", &query, &editDistance))
@@ -85,10 +222,71 @@ WrapperSimpleEd_search(flamingo_WrapperSimpleEd* self, PyObject *args) {
     return ret;
 }
 
+static PyObject *
+WrapperSimpleEd_insert(flamingo_WrapperSimpleEd* self, PyObject *args) {
+    const char * str;
+    if (!PyArg_ParseTuple(args, "s", &str))
+        return NULL;
+
+    self->index->insertString(str);
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+WrapperSimpleEd_remove(flamingo_WrapperSimpleEd* self, PyObject *args) {
+    const char * str;
+    if (!PyArg_ParseTuple(args, "s", &str))
+        return NULL;
+
+    /* find the string's id with an exact search, rather than keeping a map
+       of every string; deleted ids are filtered out of search results, so
+       no rebuild is needed */
+    vector<unsigned> resultStringIDs;
+    string tmp;
+    self->index->search(str, 0, resultStringIDs);
+    for (unsigned i = 0; i < resultStringIDs.size(); i++) {
+        self->strContainer->retrieveString(tmp, resultStringIDs[i]);
+        if (tmp == str) {
+            self->index->deleteString(resultStringIDs[i]);
+            Py_RETURN_NONE;
+        }
+    }
+    PyErr_SetString(PyExc_KeyError, str);
+    return NULL;
+}
+
 
 static PyMethodDef WrapperSimpleEdMethods[] = {
-    {"search", (PyCFunction)WrapperSimpleEd_search, METH_VARARGS,
-     "Return the name, combining the first and last name"
+    {"search", (PyCFunction)index_search<flamingo_WrapperSimpleEd>,
+     METH_VARARGS, "Return the name, combining the first and last name"
+    },
+    {"insert", (PyCFunction)WrapperSimpleEd_insert, METH_VARARGS,
+     "Add a string to the index without rebuilding it"
+    },
+    {"remove", (PyCFunction)WrapperSimpleEd_remove, METH_VARARGS,
+     "Remove a string from the index without rebuilding it"
+    },
+    {NULL}  /* Sentinel */
+};
+
+
+static PyMethodDef WrapperDiscardListsEdMethods[] = {
+    {"search", (PyCFunction)index_search<flamingo_WrapperDiscardListsEd>,
+     METH_VARARGS, "Return all strings within an edit distance of the query"
+    },
+    {NULL}  /* Sentinel */
+};
+
+static PyMethodDef WrapperCombineListsEdMethods[] = {
+    {"search", (PyCFunction)index_search<flamingo_WrapperCombineListsEd>,
+     METH_VARARGS, "Return all strings within an edit distance of the query"
+    },
+    {NULL}  /* Sentinel */
+};
+
+static PyMethodDef WrapperOnDiskEdMethods[] = {
+    {"search", (PyCFunction)index_search<flamingo_WrapperOnDiskEd>,
+     METH_VARARGS, "Return all strings within an edit distance of the query"
     },
     {NULL}  /* Sentinel */
 };
@@ -125,9 +323,253 @@ flamingo_distance(PyObject *self, PyObject *args) {
 }
 
 
+/* Python's s[start:end], for non-negative start and end */
+static string py_slice(const string & s, size_t start, size_t end) {
+    if (start >= s.size() || end <= start)
+        return "";
+    return s.substr(start, min(end, s.size()) - start);
+}
+
+/* check a list of dictionaries of barcodes to names, each of a single
+   barcode length, and find those lengths, returning false on error. The
+   dictionaries are borrowed rather than copied, since they can hold a whole
+   catalog */
+static bool parse_exact_dicts(PyObject * dictList, vector<PyObject *> & exact,
+                              vector<size_t> & lengths) {
+    if (!PyList_Check(dictList)) {
+        PyErr_SetString(PyExc_TypeError, "expected a list of dictionaries");
+        return false;
+    }
+    for (Py_ssize_t i = 0; i < PyList_Size(dictList); i++) {
+        PyObject * dict = PyList_GetItem(dictList, i);
+        if (!PyDict_Check(dict)) {
+            PyErr_SetString(PyExc_TypeError, "expected a dictionary");
+            return false;
+        }
+        PyObject * key;
+        PyObject * value;
+        Py_ssize_t pos = 0;
+        if (!PyDict_Next(dict, &pos, &key, &value))
+            continue;
+        if (!PyString_Check(key) || PyString_Size(key) == 0) {
+            PyErr_SetString(PyExc_ValueError, "barcodes must be non-empty "
+                            "strings");
+            return false;
+        }
+        exact.push_back(dict);
+        lengths.push_back(PyString_Size(key));
+    }
+    return true;
+}
+
+/* count the barcodes in a file of reads, see BarcodeCounter.count_native */
+static PyObject *
+flamingo_count_reads(PyObject *self, PyObject *args) {
+    const char * filename;
+    const char * format;
+    int barcodeStart, barcodeEnd, tagStart, tagEnd;
+    PyObject * exactList;
+    PyObject * decodeTag;
+    PyObject * resolve;
+    long maxReads;
+    if (!PyArg_ParseTuple(args, "ssiiiiO!OOl", &filename, &format,
+                          &barcodeStart, &barcodeEnd, &tagStart, &tagEnd,
+                          &PyList_Type, &exactList, &decodeTag, &resolve,
+                          &maxReads))
+        return NULL;
+
+    if (barcodeStart < 0 || barcodeEnd < 0 || tagStart < 0 || tagEnd < 0) {
+        PyErr_SetString(PyExc_ValueError, "positions must be non-negative");
+        return NULL;
+    }
+    if (!PyCallable_Check(decodeTag) || !PyCallable_Check(resolve)) {
+        PyErr_SetString(PyExc_TypeError, "tag decoder and resolver must be "
+                        "callable");
+        return NULL;
+    }
+
+    /* every linesPerRecord lines, the sequence is on line seqLine */
+    string fmt(format);
+    int linesPerRecord = 1, seqLine = 0;
+    if (fmt == "fastq")
+        linesPerRecord = 4, seqLine = 1;
+    else if (fmt == "fasta")
+        linesPerRecord = 2, seqLine = 1;
+    else if (fmt != "txt" && fmt != "qseq") {
+        PyErr_Format(PyExc_ValueError, "Unknown format %s", format);
+        return NULL;
+    }
+
+    long numTags = PyList_Size(exactList);
+    vector<vector<PyObject *> > exact(numTags);
+    vector<vector<size_t> > lengths(numTags);
+    for (long t = 0; t < numTags; t++)
+        if (!parse_exact_dicts(PyList_GetItem(exactList, t), exact[t],
+                               lengths[t]))
+            return NULL;
+
+    FILE * inf = fopen(filename, "r");
+    if (inf == NULL)
+        return PyErr_SetFromErrnoWithFilename(PyExc_IOError,
+                                              (char *) filename);
+
+    /* the results of each distinct tag code and inexact barcode, so that
+       Python is only called the first time each is seen */
+    tr1::unordered_map<string, long> tagCache;
+    vector<tr1::unordered_map<string, string> > matched(numTags);
+    vector<tr1::unordered_set<string> > unmatched(numTags);
+
+    vector<map<string, long> > counts(numTags);
+    long total = 0, totalFound = 0;
+    bool error = false;
+
+    char * buf = NULL;
+    size_t bufSize = 0;
+    ssize_t len;
+    for (long i = 0; (maxReads < 0 || total < maxReads) &&
+                     (len = ::getline(&buf, &bufSize, inf)) != -1; i++) {
+        if (i % linesPerRecord != seqLine)
+            continue;
+
+        /* the sequence exactly as the iterate_* functions give it, which
+           keeps the newline for fastq and fasta */
+        string line(buf, len);
+        if (fmt == "txt")
+            line.erase(line.size() - 1);
+        else if (fmt == "qseq") {
+            size_t pos = 0;
+            for (int field = 0; field < 8 && pos != string::npos; field++) {
+                pos = line.find('\t', pos);
+                if (pos != string::npos)
+                    pos++;
+            }
+            if (pos == string::npos) {
+                PyErr_SetString(PyExc_IndexError, "qseq line has fewer "
+                                "than 9 fields");
+                error = true;
+                break;
+            }
+            line = line.substr(pos, line.find('\t', pos) - pos);
+        }
+        total++;
+
+        string tagcode = py_slice(line, tagStart, tagEnd);
+        long whichtag;
+        tr1::unordered_map<string, long>::iterator tagIt =
+            tagCache.find(tagcode);
+        if (tagIt != tagCache.end())
+            whichtag = tagIt->second;
+        else {
+            PyObject * r = PyObject_CallFunction(decodeTag, (char *) "s#",
+                                                 tagcode.data(),
+                                                 (int) tagcode.size());
+            if (r == NULL) {
+                error = true;
+                break;
+            }
+            whichtag = (r == Py_None ? -1 : PyInt_AsLong(r));
+            Py_DECREF(r);
+            if (whichtag >= numTags || (whichtag < -1 && !PyErr_Occurred()))
+                PyErr_SetString(PyExc_ValueError, "tag out of range");
+            if (PyErr_Occurred()) {
+                error = true;
+                break;
+            }
+            tagCache[tagcode] = whichtag;
+        }
+        if (whichtag == -1)
+            continue;
+
+        string barcode = py_slice(line, barcodeStart, barcodeEnd);
+
+        /* exact matches, in the order the dictionaries were given */
+        const string * name = NULL;
+        string exactName;
+        for (size_t j = 0; j < lengths[whichtag].size() && name == NULL; j++) {
+            size_t l = lengths[whichtag][j];
+            if (l > barcode.size())
+                continue;
+            PyObject * key = PyString_FromStringAndSize(barcode.data(), l);
+            if (key == NULL) {
+                error = true;
+                break;
+            }
+            PyObject * v = PyDict_GetItem(exact[whichtag][j], key);
+            Py_DECREF(key);
+            if (v != NULL) {
+                char * s = PyString_AsString(v);
+                if (s == NULL) {
+                    error = true;
+                    break;
+                }
+                exactName = s;
+                name = &exactName;
+            }
+        }
+        if (error)
+            break;
+
+        /* inexact matches, searched for by Python */
+        if (name == NULL) {
+            if (unmatched[whichtag].count(barcode))
+                continue;
+            tr1::unordered_map<string, string>::iterator it =
+                matched[whichtag].find(barcode);
+            if (it != matched[whichtag].end())
+                name = &it->second;
+            else {
+                PyObject * r = PyObject_CallFunction(resolve, (char *) "ls#",
+                                                     whichtag, barcode.data(),
+                                                     (int) barcode.size());
+                if (r == NULL) {
+                    error = true;
+                    break;
+                }
+                if (r == Py_None) {
+                    Py_DECREF(r);
+                    unmatched[whichtag].insert(barcode);
+                    continue;
+                }
+                char * s = PyString_AsString(r);
+                if (s == NULL) {
+                    Py_DECREF(r);
+                    error = true;
+                    break;
+                }
+                name = &(matched[whichtag][barcode] = s);
+                Py_DECREF(r);
+            }
+        }
+
+        counts[whichtag][*name]++;
+        totalFound++;
+    }
+
+    free(buf);
+    fclose(inf);
+    if (error)
+        return NULL;
+
+    PyObject * countList = PyList_New(numTags);
+    for (long t = 0; t < numTags; t++) {
+        PyObject * d = PyDict_New();
+        for (map<string, long>::iterator it = counts[t].begin();
+             it != counts[t].end(); it++) {
+            PyObject * v = PyInt_FromLong(it->second);
+            PyDict_SetItemString(d, it->first.c_str(), v);
+            Py_DECREF(v);
+        }
+        PyList_SetItem(countList, t, d);
+    }
+    return Py_BuildValue("llN", total, totalFound, countList);
+}
+
+
 static PyMethodDef FlamingoMethods[] = {
         {"distance", flamingo_distance, METH_VARARGS,
          "Caculate the Levenshtein edit distance."},
+        {"count_reads", flamingo_count_reads, METH_VARARGS,
+         "Count the barcodes in a file of reads for each tag."},
         {NULL, NULL, 0, NULL}               /* Sentinel */
 };
 
@@ -173,6 +615,132 @@ static PyTypeObject flamingo_WrapperSimpleEdType = {
     0,                 /* tp_new TODO */
 };
 
+static PyTypeObject flamingo_WrapperDiscardListsEdType = {
+    PyObject_HEAD_INIT(NULL)
+    0,                         /*ob_size*/
+    "flamingo.WrapperDiscardListsEd",             /*tp_name*/
+    sizeof(flamingo_WrapperDiscardListsEd),             /*tp_basicsize*/
+    0,                         /*tp_itemsize*/
+    0, /*tp_dealloc*/
+    0,                         /*tp_print*/
+    0,                         /*tp_getattr*/
+    0,                         /*tp_setattr*/
+    0,                         /*tp_compare*/
+    0,                         /*tp_repr*/
+    0,                         /*tp_as_number*/
+    0,                         /*tp_as_sequence*/
+    0,                         /*tp_as_mapping*/
+    0,                         /*tp_hash */
+    0,                         /*tp_call*/
+    0,                         /*tp_str*/
+    0,                         /*tp_getattro*/
+    0,                         /*tp_setattro*/
+    0,                         /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE, /*tp_flags*/
+    "flamingo index compressed by discarding lists",           /* tp_doc */
+    0,		               /* tp_traverse */
+    0,		               /* tp_clear */
+    0,		               /* tp_richcompare */
+    0,		               /* tp_weaklistoffset */
+    0,		               /* tp_iter */
+    0,		               /* tp_iternext */
+    WrapperDiscardListsEdMethods,             /* tp_methods */ 
+    0,             /* tp_members TODO */
+    0,           /* tp_getset TODO */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    (initproc)WrapperDiscardListsEd_init,      /* tp_init */
+    0,                         /* tp_alloc */
+    0,                 /* tp_new TODO */
+};
+
+static PyTypeObject flamingo_WrapperCombineListsEdType = {
+    PyObject_HEAD_INIT(NULL)
+    0,                         /*ob_size*/
+    "flamingo.WrapperCombineListsEd",             /*tp_name*/
+    sizeof(flamingo_WrapperCombineListsEd),             /*tp_basicsize*/
+    0,                         /*tp_itemsize*/
+    0, /*tp_dealloc*/
+    0,                         /*tp_print*/
+    0,                         /*tp_getattr*/
+    0,                         /*tp_setattr*/
+    0,                         /*tp_compare*/
+    0,                         /*tp_repr*/
+    0,                         /*tp_as_number*/
+    0,                         /*tp_as_sequence*/
+    0,                         /*tp_as_mapping*/
+    0,                         /*tp_hash */
+    0,                         /*tp_call*/
+    0,                         /*tp_str*/
+    0,                         /*tp_getattro*/
+    0,                         /*tp_setattro*/
+    0,                         /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE, /*tp_flags*/
+    "flamingo index compressed by combining lists",           /* tp_doc */
+    0,		               /* tp_traverse */
+    0,		               /* tp_clear */
+    0,		               /* tp_richcompare */
+    0,		               /* tp_weaklistoffset */
+    0,		               /* tp_iter */
+    0,		               /* tp_iternext */
+    WrapperCombineListsEdMethods,             /* tp_methods */ 
+    0,             /* tp_members TODO */
+    0,           /* tp_getset TODO */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    (initproc)WrapperCombineListsEd_init,      /* tp_init */
+    0,                         /* tp_alloc */
+    0,                 /* tp_new TODO */
+};
+
+static PyTypeObject flamingo_WrapperOnDiskEdType = {
+    PyObject_HEAD_INIT(NULL)
+    0,                         /*ob_size*/
+    "flamingo.WrapperOnDiskEd",             /*tp_name*/
+    sizeof(flamingo_WrapperOnDiskEd),             /*tp_basicsize*/
+    0,                         /*tp_itemsize*/
+    0, /*tp_dealloc*/
+    0,                         /*tp_print*/
+    0,                         /*tp_getattr*/
+    0,                         /*tp_setattr*/
+    0,                         /*tp_compare*/
+    0,                         /*tp_repr*/
+    0,                         /*tp_as_number*/
+    0,                         /*tp_as_sequence*/
+    0,                         /*tp_as_mapping*/
+    0,                         /*tp_hash */
+    0,                         /*tp_call*/
+    0,                         /*tp_str*/
+    0,                         /*tp_getattro*/
+    0,                         /*tp_setattro*/
+    0,                         /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE, /*tp_flags*/
+    "flamingo disk-based index",           /* tp_doc */
+    0,		               /* tp_traverse */
+    0,		               /* tp_clear */
+    0,		               /* tp_richcompare */
+    0,		               /* tp_weaklistoffset */
+    0,		               /* tp_iter */
+    0,		               /* tp_iternext */
+    WrapperOnDiskEdMethods,             /* tp_methods */ 
+    0,             /* tp_members TODO */
+    0,           /* tp_getset TODO */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    (initproc)WrapperOnDiskEd_init,      /* tp_init */
+    0,                         /* tp_alloc */
+    0,                 /* tp_new TODO */
+};
+
 
 PyMODINIT_FUNC
 initflamingo(void)
@@ -183,6 +751,21 @@ initflamingo(void)
     if (PyType_Ready(&flamingo_WrapperSimpleEdType) < 0)
         return;
     PyModule_AddObject(m, "WrapperSimpleEd", (PyObject *) &flamingo_WrapperSimpleEdType);
+
+    flamingo_WrapperDiscardListsEdType.tp_new = PyType_GenericNew;
+    if (PyType_Ready(&flamingo_WrapperDiscardListsEdType) < 0)
+        return;
+    PyModule_AddObject(m, "WrapperDiscardListsEd", (PyObject *) &flamingo_WrapperDiscardListsEdType);
+
+    flamingo_WrapperCombineListsEdType.tp_new = PyType_GenericNew;
+    if (PyType_Ready(&flamingo_WrapperCombineListsEdType) < 0)
+        return;
+    PyModule_AddObject(m, "WrapperCombineListsEd", (PyObject *) &flamingo_WrapperCombineListsEdType);
+
+    flamingo_WrapperOnDiskEdType.tp_new = PyType_GenericNew;
+    if (PyType_Ready(&flamingo_WrapperOnDiskEdType) < 0)
+        return;
+    PyModule_AddObject(m, "WrapperOnDiskEd", (PyObject *) &flamingo_WrapperOnDiskEdType);
 }
 
 int